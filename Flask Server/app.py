@@ -2,38 +2,119 @@ from flask import Flask, request, jsonify, send_file, Response, stream_with_cont
 from flask_cors import CORS
 from dotenv import load_dotenv
 import os
+
+# Load .env before the local modules below read their settings
+load_dotenv()
+
 from datetime import datetime, UTC
-from database import get_db, init_db, Dataset, ChorusModel, Bot, ChatHistory, UploadedFile
-from vector_store import VectorStore
+from database import get_db, init_db, remove_db, Dataset, ChorusModel, Bot, ChatHistory, UploadedFile, IngestionJob, IngestionJobFile
+from vector_store import VectorStore, CHROMA_HOST
 from file_processor import FileProcessor
 from chorus_service import ChorusService
-from chart_generator import ChartGenerator
+from chart_generator import ChartGenerator, CHART_MODEL
+from context_builder import ContextBuilder, truncate_to_tokens
+from response_cache import ResponseCache
+from llm_service import get_llm_service
+from ingestion_worker import IngestionWorker
 from werkzeug.utils import secure_filename
 import uuid
 import shutil
-
-load_dotenv()
+import zipfile
+import threading
+import time
+import json
 
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=['X-Next-Before'])
+
+# Services are created by create_app() rather than at import: worker processes started
+# with spawn (e.g. the PDF extraction pool) import this module as __mp_main__, and must
+# not open the stores or start another ingestion worker
+llm_service = None
+vector_store = None
+file_processor = None
+chorus_service = None
+chart_generator = None
+context_builder = None
+response_cache = None
+ingestion_worker = None
 
-# Initialize services
-vector_store = VectorStore()
-file_processor = FileProcessor()
-chorus_service = ChorusService()
-chart_generator = ChartGenerator()
+# Context included when asking for a chart explanation (tokens)
+CHART_EXPLANATION_CONTEXT_TOKENS = int(os.getenv('CHART_EXPLANATION_CONTEXT_TOKENS', '5000'))
 
 # Upload folder
 UPLOAD_FOLDER = 'uploads'
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
 # Generated charts folder
 CHARTS_FOLDER = 'generated_charts'
-os.makedirs(CHARTS_FOLDER, exist_ok=True)
 
-# Initialize database
-init_db()
+def create_app():
+    """
+    Initialize services, the database and background threads, and return the app
+    Called once per server process by `python app.py`; WSGI servers can load "app:create_app()".
+    """
+    global llm_service, vector_store, file_processor, chorus_service, chart_generator, context_builder, response_cache, ingestion_worker
+    if ingestion_worker is not None:
+        return app
+    
+    # Initialize services
+    llm_service = get_llm_service()
+    vector_store = VectorStore()
+    file_processor = FileProcessor()
+    chorus_service = ChorusService()
+    chart_generator = ChartGenerator()
+    context_builder = ContextBuilder()
+    response_cache = ResponseCache()
+    ingestion_worker = IngestionWorker(file_processor, vector_store)
+    
+    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+    os.makedirs(CHARTS_FOLDER, exist_ok=True)
+    
+    # Initialize database
+    init_db()
+    
+    # Open provider connections in the background so the first chat skips the TLS handshake
+    threading.Thread(target=llm_service.warm_up, daemon=True).start()
+    
+    # Process uploads in the background; set INGEST_EMBEDDED_WORKER=false when running
+    # ingestion_worker.py as a separate process instead (which requires a Chroma server)
+    if os.getenv('INGEST_EMBEDDED_WORKER', 'true').lower() in ('1', 'true', 'yes'):
+        ingestion_worker.start()
+    elif not CHROMA_HOST:
+        print("Warning: INGEST_EMBEDDED_WORKER is off but CHROMA_HOST is not set; vectors written by a separate worker won't be visible to this server")
+    
+    return app
+
+@app.teardown_appcontext
+def shutdown_session(exception=None):
+    """Release the request's database session"""
+    remove_db()
+
+# Cursor pagination (?before=<id>&limit=<n>) for list endpoints
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+def wants_all_rows() -> bool:
+    """True when a list endpoint was asked for every row (?all=true) instead of one page"""
+    return request.args.get('all', 'false').lower() in ('1', 'true', 'yes')
+
+def paginate(query, id_column):
+    """
+    Apply ?before=<id>&limit=<n> to a query
+    Returns (rows in ascending id order, id to pass as ?before= for the previous page or None)
+    """
+    before = request.args.get('before', type=int)
+    limit = min(max(request.args.get('limit', DEFAULT_PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+    
+    if before is not None:
+        query = query.filter(id_column < before)
+    rows = query.order_by(id_column.desc()).limit(limit + 1).all()
+    
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    rows.reverse()
+    return rows, (rows[0].id if has_more else None)
 
 # ==================== DATASET ENDPOINTS ====================
 
@@ -93,265 +174,236 @@ def create_dataset():
         print(f"Error creating dataset: {e}")
         return jsonify({'error': f'Failed to create dataset: {str(e)}'}), 500
 
-@app.route('/api/datasets/<int:dataset_id>/upload', methods=['POST'])
-def upload_files(dataset_id):
-    """Upload files to a dataset (including ZIP files that will be extracted) with streaming progress"""
-    import json
-    
-    def send_progress(event_type, data):
-        """Helper to format SSE messages"""
-        return f"event: {event_type}\ndata: {json.dumps(data)}\n\n"
+def sse_event(event_type, data, event_id=None):
+    """Format an SSE message"""
+    message = f"id: {event_id}\n" if event_id is not None else ""
+    return message + f"event: {event_type}\ndata: {json.dumps(data)}\n\n"
+
+# Limits applied to uploaded ZIP archives (zip bomb protection)
+ZIP_MAX_MEMBERS = int(os.getenv('ZIP_MAX_MEMBERS', '10000'))
+ZIP_MAX_TOTAL_BYTES = int(os.getenv('ZIP_MAX_TOTAL_BYTES', str(2 * 1024 ** 3)))
+ZIP_MAX_MEMBER_BYTES = int(os.getenv('ZIP_MAX_MEMBER_BYTES', str(512 * 1024 ** 2)))
+ZIP_MAX_COMPRESSION_RATIO = int(os.getenv('ZIP_MAX_COMPRESSION_RATIO', '200'))
+ZIP_COPY_BUFFER = 1024 * 1024
+
+def extract_zip(stream, zip_name, dataset_folder):
+    """
+    Extract a ZIP archive member by member straight to its stored path
+    The central directory is read once from the upload stream and checked against the
+    size/count limits before anything is written. Sizes are enforced again while copying
+    since the directory can lie. Returns staged file dicts; on failure nothing is kept.
+    """
+    members = []
+    declared_total = 0
     
-    def generate():
-        """Generator that yields progress updates during upload"""
+    with zipfile.ZipFile(stream, 'r') as zip_ref:
+        for info in zip_ref.infolist():
+            if info.is_dir() or info.filename.startswith('__MACOSX'):
+                continue
+            if info.file_size > ZIP_MAX_MEMBER_BYTES:
+                raise ValueError(f"'{info.filename}' is larger than {ZIP_MAX_MEMBER_BYTES} bytes")
+            if info.compress_size and info.file_size / info.compress_size > ZIP_MAX_COMPRESSION_RATIO:
+                raise ValueError(f"'{info.filename}' exceeds the maximum compression ratio")
+            declared_total += info.file_size
+            members.append(info)
+        
+        if len(members) > ZIP_MAX_MEMBERS:
+            raise ValueError(f"Archive has more than {ZIP_MAX_MEMBERS} files")
+        if declared_total > ZIP_MAX_TOTAL_BYTES:
+            raise ValueError(f"Archive expands to more than {ZIP_MAX_TOTAL_BYTES} bytes")
+        
+        staged_files = []
+        written_total = 0
         try:
-            db = get_db()
-            dataset = db.query(Dataset).filter_by(id=dataset_id).first()
-            
-            if not dataset:
-                yield send_progress('error', {'message': 'Dataset not found'})
-                return
-            
-            if 'files' not in request.files:
-                yield send_progress('error', {'message': 'No files provided'})
-                return
-            
-            # Create dataset-specific folder
-            dataset_folder = os.path.join(app.config['UPLOAD_FOLDER'], f"dataset_{dataset.id}")
-            os.makedirs(dataset_folder, exist_ok=True)
-            
-            files = request.files.getlist('files')
-            processed_files = []
-            errors = []
-            total_files = 0
-            processed_count = 0
-            
-            # Count total files including those in ZIP files
-            for file in files:
-                if file.filename:
-                    filename = secure_filename(file.filename)
-                    if filename.lower().endswith('.zip'):
-                        # Count files in ZIP
-                        temp_zip_path = os.path.join(dataset_folder, f"temp_{filename}")
-                        file.save(temp_zip_path)
-                        try:
-                            import zipfile
-                            with zipfile.ZipFile(temp_zip_path, 'r') as zip_ref:
-                                total_files += len([f for f in zip_ref.namelist() if not f.endswith('/')])
-                        except Exception as e:
-                            print(f"Error counting ZIP files: {e}")
-                            total_files += 1
-                        finally:
-                            if os.path.exists(temp_zip_path):
-                                os.remove(temp_zip_path)
-                        
-                        # Seek back to beginning of file stream for next save
-                        file.seek(0)
-                    else:
-                        total_files += 1
-            
-            print(f"Total files to process: {total_files}")
-            yield send_progress('status', {'message': f'Preparing to process {total_files} file(s)...', 'total': total_files, 'processed': 0})
-            
-            for file in files:
-                if file.filename == '':
+            for info in members:
+                # Get just the filename (remove directory path)
+                original_filename = secure_filename(os.path.basename(info.filename))
+                if not original_filename:
                     continue
                 
+                stored_filename = f"{uuid.uuid4().hex}_{original_filename}"
+                final_path = os.path.join(dataset_folder, stored_filename)
+                staged_files.append({
+                    'filename': original_filename,
+                    'stored_filename': stored_filename,
+                    'file_path': final_path,
+                    'from_zip': zip_name
+                })
+                
+                written = 0
+                with zip_ref.open(info) as source, open(final_path, 'wb') as target:
+                    while True:
+                        block = source.read(ZIP_COPY_BUFFER)
+                        if not block:
+                            break
+                        written += len(block)
+                        written_total += len(block)
+                        if written > info.file_size or written_total > ZIP_MAX_TOTAL_BYTES:
+                            raise ValueError(f"'{info.filename}' expands beyond its declared size")
+                        target.write(block)
+        except Exception:
+            for staged in staged_files:
+                if os.path.exists(staged['file_path']):
+                    os.remove(staged['file_path'])
+            raise
+    
+    return staged_files
+
+def stage_uploaded_files(files, dataset_folder):
+    """
+    Save uploaded files (extracting ZIPs) into the dataset folder
+    Returns (staged files in upload order, errors)
+    """
+    staged_files = []
+    errors = []
+    
+    for file in files:
+        if file.filename == '':
+            continue
+        
+        try:
+            filename = secure_filename(file.filename)
+            file_extension = os.path.splitext(filename)[1].lower()
+            
+            # Check if this is a ZIP file
+            if file_extension == '.zip':
                 try:
-                    filename = secure_filename(file.filename)
-                    file_extension = os.path.splitext(filename)[1].lower()
-                    
-                    # Check if this is a ZIP file
-                    if file_extension == '.zip':
-                        # Handle ZIP file extraction
-                        import zipfile
-                        
-                        # Save ZIP to temp location
-                        temp_zip_path = os.path.join(dataset_folder, f"temp_{uuid.uuid4().hex}.zip")
-                        file.save(temp_zip_path)
-                        
-                        try:
-                            # Extract ZIP file
-                            print(f"Extracting ZIP file '{filename}'")
-                            yield send_progress('status', {'message': f'Extracting {filename}...', 'total': total_files, 'processed': processed_count})
-                            
-                            with zipfile.ZipFile(temp_zip_path, 'r') as zip_ref:
-                                # Get list of files in ZIP
-                                zip_files = [f for f in zip_ref.namelist() if not f.endswith('/') and not f.startswith('__MACOSX')]
-                                
-                                # Create temp extraction folder
-                                extract_folder = os.path.join(dataset_folder, f"temp_extract_{uuid.uuid4().hex}")
-                                os.makedirs(extract_folder, exist_ok=True)
-                                
-                                # Extract all files
-                                zip_ref.extractall(extract_folder)
-                                
-                                print(f"Extracted {len(zip_files)} files from ZIP")
-                                
-                                # Process each extracted file one by one
-                                for zip_file_name in zip_files:
-                                    processed_count += 1
-                                    
-                                    try:
-                                        extracted_path = os.path.join(extract_folder, zip_file_name)
-                                        
-                                        if not os.path.isfile(extracted_path):
-                                            print(f"Skipping {zip_file_name} - not a file")
-                                            continue
-                                        
-                                        # Get just the filename (remove directory path)
-                                        original_filename = os.path.basename(zip_file_name)
-                                        original_filename = secure_filename(original_filename)
-                                        
-                                        print(f"Processing file {processed_count}/{total_files}: {original_filename}")
-                                        yield send_progress('status', {'message': f'Processing {original_filename}...', 'total': total_files, 'processed': processed_count, 'filename': original_filename})
-                                        
-                                        # Move to dataset folder with unique name
-                                        stored_filename = f"{uuid.uuid4().hex}_{original_filename}"
-                                        final_path = os.path.join(dataset_folder, stored_filename)
-                                        shutil.move(extracted_path, final_path)
-                                        
-                                        file_size = os.path.getsize(final_path)
-                                        
-                                        # Process file
-                                        documents = file_processor.process_file(final_path, original_filename)
-                                        
-                                        # Add to vector store
-                                        vector_store.add_documents(dataset.collection_name, documents)
-                                        
-                                        # Save file metadata
-                                        uploaded_file = UploadedFile(
-                                            dataset_id=dataset.id,
-                                            original_filename=original_filename,
-                                            stored_filename=stored_filename,
-                                            file_path=final_path,
-                                            file_type=os.path.splitext(original_filename)[1],
-                                            file_size=file_size,
-                                            chunks_count=len(documents)
-                                        )
-                                        db.add(uploaded_file)
-                                        db.flush()  # Flush to get the ID
-                                        
-                                        file_id = uploaded_file.id
-                                        db.commit()  # Commit each file immediately
-                                        
-                                        processed_files.append({
-                                            'id': file_id,
-                                            'filename': original_filename,
-                                            'chunks': len(documents),
-                                            'size': file_size,
-                                            'from_zip': filename
-                                        })
-                                        print(f"✓ Successfully saved: {original_filename} (ID: {file_id})")
-                                        
-                                    except Exception as e:
-                                        errors.append({
-                                            'filename': os.path.basename(zip_file_name),
-                                            'error': f"Error in ZIP: {str(e)}"
-                                        })
-                                        print(f"✗ ERROR processing {zip_file_name}: {e}")
-                                        import traceback
-                                        traceback.print_exc()
-                            
-                            # Cleanup temp extraction folder
-                            shutil.rmtree(extract_folder, ignore_errors=True)
-                        
-                        except Exception as e:
-                            print(f"Error extracting ZIP file: {e}")
-                            errors.append({
-                                'filename': filename,
-                                'error': f"Error extracting ZIP: {str(e)}"
-                            })
-                            import traceback
-                            traceback.print_exc()
-                        finally:
-                            # Remove temp ZIP file
-                            if os.path.exists(temp_zip_path):
-                                os.remove(temp_zip_path)
-                    
-                    else:
-                        # Regular file upload (not a ZIP)
-                        processed_count += 1
-                        print(f"Processing file {processed_count}/{total_files}: {filename}")
-                        yield send_progress('status', {'message': f'Processing {filename}...', 'total': total_files, 'processed': processed_count, 'filename': filename})
-                        
-                        stored_filename = f"{uuid.uuid4().hex}_{filename}"
-                        file_path = os.path.join(dataset_folder, stored_filename)
-                        
-                        # Save file persistently
-                        file.save(file_path)
-                        file_size = os.path.getsize(file_path)
-                        
-                        # Process file and extract text/embeddings
-                        documents = file_processor.process_file(file_path, filename)
-                        
-                        # Add to vector store
-                        vector_store.add_documents(dataset.collection_name, documents)
-                        
-                        # Save file metadata to database
-                        uploaded_file = UploadedFile(
-                            dataset_id=dataset.id,
-                            original_filename=filename,
-                            stored_filename=stored_filename,
-                            file_path=file_path,
-                            file_type=os.path.splitext(filename)[1],
-                            file_size=file_size,
-                            chunks_count=len(documents)
-                        )
-                        db.add(uploaded_file)
-                        db.flush()  # Flush to get the ID
-                        
-                        file_id = uploaded_file.id
-                        db.commit()  # Commit each file immediately
-                        
-                        processed_files.append({
-                            'id': file_id,
-                            'filename': filename,
-                            'chunks': len(documents),
-                            'size': file_size
-                        })
-                        print(f"Successfully added file: {filename} (ID: {file_id})")
-                        
+                    print(f"Extracting ZIP file '{filename}'")
+                    extracted = extract_zip(file.stream, filename, dataset_folder)
+                    print(f"Extracted {len(extracted)} files from ZIP")
+                    staged_files.extend(extracted)
                 except Exception as e:
+                    print(f"Error extracting ZIP file: {e}")
                     errors.append({
-                        'filename': file.filename,
-                        'error': str(e)
+                        'filename': filename,
+                        'error': f"Error extracting ZIP: {str(e)}"
                     })
-                    print(f"Error processing file {file.filename}: {e}")
-        
-            # Update file count
-            dataset.file_count += len(processed_files)
-            db.commit()
-            
-            response = {
-                'message': f'Processed {len(processed_files)} files',
-                'files': processed_files
-            }
-            
-            if errors:
-                response['errors'] = errors
-                response['message'] += f', {len(errors)} failed'
-            
-            yield send_progress('final', response)
             
+            else:
+                # Regular file upload (not a ZIP) - save file persistently
+                stored_filename = f"{uuid.uuid4().hex}_{filename}"
+                file_path = os.path.join(dataset_folder, stored_filename)
+                file.save(file_path)
+                
+                staged_files.append({
+                    'filename': filename,
+                    'stored_filename': stored_filename,
+                    'file_path': file_path
+                })
+                
         except Exception as e:
-            db.rollback()
-            print(f"Error uploading files: {e}")
-            yield send_progress('error', {'message': f'Failed to upload files: {str(e)}'})
+            errors.append({
+                'filename': file.filename,
+                'error': str(e)
+            })
+            print(f"Error saving file {file.filename}: {e}")
+    
+    return staged_files, errors
+
+def job_summary(db, job):
+    """Upload summary for a job, in the shape the upload endpoint used to stream as 'final'"""
+    job_files = db.query(IngestionJobFile).filter_by(job_id=job.id).order_by(IngestionJobFile.position).all()
+    
+    processed_files = []
+    errors = list(job.errors or [])
+    for job_file in job_files:
+        if job_file.status == 'completed':
+            processed_file = {
+                'id': job_file.uploaded_file_id,
+                'filename': job_file.filename,
+                'chunks': job_file.chunks_count,
+                'size': job_file.file_size
+            }
+            if job_file.from_zip:
+                processed_file['from_zip'] = job_file.from_zip
+            processed_files.append(processed_file)
+        elif job_file.status == 'failed':
+            errors.append({
+                'filename': job_file.filename,
+                'error': f"Error in ZIP: {job_file.error}" if job_file.from_zip else job_file.error
+            })
     
-    return Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response = {
+        'message': f'Processed {len(processed_files)} files',
+        'files': processed_files
+    }
+    if errors:
+        response['errors'] = errors
+        response['message'] += f', {len(errors)} failed'
+    return response
+
+@app.route('/api/datasets/<int:dataset_id>/upload', methods=['POST'])
+def upload_files(dataset_id):
+    """
+    Upload files to a dataset (including ZIP files that will be extracted)
+    Files are stored and queued as an ingestion job; returns the job id. Progress is
+    available from /api/jobs/<id> and /api/jobs/<id>/stream.
+    """
+    try:
+        db = get_db()
+        dataset = db.query(Dataset).filter_by(id=dataset_id).first()
+        
+        if not dataset:
+            return jsonify({'error': 'Dataset not found'}), 404
+        
+        if 'files' not in request.files:
+            return jsonify({'error': 'No files provided'}), 400
+        
+        # Create dataset-specific folder
+        dataset_folder = os.path.join(app.config['UPLOAD_FOLDER'], f"dataset_{dataset.id}")
+        os.makedirs(dataset_folder, exist_ok=True)
+        
+        staged_files, errors = stage_uploaded_files(request.files.getlist('files'), dataset_folder)
+        
+        job = IngestionJob(
+            dataset_id=dataset.id,
+            status='queued',
+            total_files=len(staged_files),
+            processed_count=0,
+            errors=errors
+        )
+        db.add(job)
+        db.flush()  # Flush to get the ID
+        
+        for position, staged in enumerate(staged_files):
+            db.add(IngestionJobFile(
+                job_id=job.id,
+                position=position,
+                filename=staged['filename'],
+                stored_filename=staged['stored_filename'],
+                file_path=staged['file_path'],
+                from_zip=staged.get('from_zip')
+            ))
+        db.commit()
+        
+        print(f"Queued ingestion job {job.id} with {len(staged_files)} file(s)")
+        return jsonify({
+            'job_id': job.id,
+            'status': job.status,
+            'total_files': job.total_files,
+            'errors': errors
+        }), 202
+    except Exception as e:
+        db.rollback()
+        print(f"Error uploading files: {e}")
+        return jsonify({'error': f'Failed to upload files: {str(e)}'}), 500
 
 @app.route('/api/datasets/<int:dataset_id>', methods=['GET'])
 def get_dataset(dataset_id):
-    """Get dataset details with files"""
+    """Get dataset details with its latest page of files (next_before pages further back)"""
     db = get_db()
     dataset = db.query(Dataset).filter_by(id=dataset_id).first()
     
     if not dataset:
         return jsonify({'error': 'Dataset not found'}), 404
     
-    # Get all files in this dataset
-    files = db.query(UploadedFile).filter_by(dataset_id=dataset_id).all()
+    # Latest page of files by default; ?all=true returns every file
+    files_query = db.query(UploadedFile).filter_by(dataset_id=dataset_id)
+    next_before = None
+    if wants_all_rows():
+        files = files_query.order_by(UploadedFile.id).all()
+    else:
+        files, next_before = paginate(files_query, UploadedFile.id)
     
     return jsonify({
         'id': dataset.id,
@@ -367,7 +419,29 @@ def get_dataset(dataset_id):
             'file_size': f.file_size,
             'chunks_count': f.chunks_count,
             'created_at': f.created_at.isoformat()
-        } for f in files]
+        } for f in files],
+        'next_before': next_before
+    })
+
+@app.route('/api/datasets/<int:dataset_id>/files', methods=['GET'])
+def get_dataset_files(dataset_id):
+    """Get a page of a dataset's files (?before=<id>&limit=<n>)"""
+    db = get_db()
+    if not db.query(Dataset.id).filter_by(id=dataset_id).first():
+        return jsonify({'error': 'Dataset not found'}), 404
+    
+    files, next_before = paginate(db.query(UploadedFile).filter_by(dataset_id=dataset_id), UploadedFile.id)
+    
+    return jsonify({
+        'files': [{
+            'id': f.id,
+            'filename': f.original_filename,
+            'file_type': f.file_type,
+            'file_size': f.file_size,
+            'chunks_count': f.chunks_count,
+            'created_at': f.created_at.isoformat()
+        } for f in files],
+        'next_before': next_before
     })
 
 @app.route('/api/datasets/<int:dataset_id>/files/<int:file_id>', methods=['GET'])
@@ -434,6 +508,92 @@ def get_file_image(dataset_id, file_id):
     except Exception as e:
         return jsonify({'error': f'Failed to read image: {str(e)}'}), 500
 
+def delete_file_vectors(db, dataset, uploaded_file):
+    """Remove a file's chunks from the dataset's collection"""
+    # Vectors written before chunk ids were keyed by file can only be matched by filename,
+    # which is safe when no other file in the dataset shares it
+    shares_name = db.query(UploadedFile.id).filter(
+        UploadedFile.dataset_id == uploaded_file.dataset_id,
+        UploadedFile.original_filename == uploaded_file.original_filename,
+        UploadedFile.id != uploaded_file.id
+    ).first() is not None
+    vector_store.delete_file_documents(
+        dataset.collection_name,
+        file_key=uploaded_file.stored_filename,
+        filename=None if shares_name else uploaded_file.original_filename
+    )
+
+def restore_file_vectors(dataset, uploaded_file):
+    """Re-index a file's stored copy after a failed update (only changed chunks are re-embedded)"""
+    try:
+        documents = file_processor.process_file(uploaded_file.file_path, uploaded_file.original_filename)
+        vector_store.sync_file_documents(dataset.collection_name, uploaded_file.stored_filename, documents)
+    except Exception as e:
+        print(f"Error restoring vectors for {uploaded_file.original_filename}: {e}")
+
+@app.route('/api/datasets/<int:dataset_id>/files/<int:file_id>', methods=['PUT'])
+def update_file(dataset_id, file_id):
+    """
+    Replace a file's content and re-index it
+    Only chunks whose content hash changed are re-embedded; removed chunks are deleted.
+    """
+    db = get_db()
+    uploaded_file = db.query(UploadedFile).filter_by(id=file_id, dataset_id=dataset_id).first()
+    
+    if not uploaded_file:
+        return jsonify({'error': 'File not found'}), 404
+    
+    file = request.files.get('file')
+    if not file or file.filename == '':
+        return jsonify({'error': 'No file provided'}), 400
+    
+    if os.path.splitext(secure_filename(file.filename))[1].lower() != (uploaded_file.file_type or '').lower():
+        return jsonify({'error': f'File type must stay {uploaded_file.file_type}'}), 400
+    
+    dataset = db.query(Dataset).filter_by(id=dataset_id).first()
+    
+    # The new upload is processed from a temp copy and only replaces the stored file
+    # once it has been re-indexed, so a failed update leaves the original in place
+    temp_path = f"{uploaded_file.file_path}.{uuid.uuid4().hex}.tmp"
+    index_touched = False
+    try:
+        file.save(temp_path)
+        
+        documents = file_processor.process_file(temp_path, uploaded_file.original_filename)
+        if all(doc['metadata'].get('type') == 'error' for doc in documents):
+            return jsonify({'error': f'Failed to process file: {documents[0]["text"] if documents else "no content"}'}), 422
+        
+        index_touched = True
+        # Files indexed before chunk ids were keyed have no file_key vectors to diff against
+        if not vector_store.has_file_documents(dataset.collection_name, uploaded_file.stored_filename):
+            delete_file_vectors(db, dataset, uploaded_file)
+        
+        changes = vector_store.sync_file_documents(dataset.collection_name, uploaded_file.stored_filename, documents)
+        os.replace(temp_path, uploaded_file.file_path)
+        
+        uploaded_file.file_size = os.path.getsize(uploaded_file.file_path)
+        uploaded_file.chunks_count = len(documents)
+        dataset.version = (dataset.version or 0) + 1
+        db.commit()
+        
+        print(f"Updated file {uploaded_file.original_filename}: {changes}")
+        return jsonify({
+            'id': uploaded_file.id,
+            'filename': uploaded_file.original_filename,
+            'chunks': uploaded_file.chunks_count,
+            'size': uploaded_file.file_size,
+            'changes': changes
+        })
+    except Exception as e:
+        db.rollback()
+        print(f"Error updating file: {e}")
+        if index_touched:
+            restore_file_vectors(dataset, uploaded_file)
+        return jsonify({'error': f'Failed to update file: {str(e)}'}), 500
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
 @app.route('/api/datasets/<int:dataset_id>/files/<int:file_id>', methods=['DELETE'])
 def delete_file(dataset_id, file_id):
     """Delete a file from dataset"""
@@ -444,6 +604,12 @@ def delete_file(dataset_id, file_id):
         return jsonify({'error': 'File not found'}), 404
     
     try:
+        dataset = db.query(Dataset).filter_by(id=dataset_id).first()
+        
+        # Delete the file's chunks so they stop showing up in retrieval
+        if dataset:
+            delete_file_vectors(db, dataset, uploaded_file)
+        
         # Delete physical file
         if os.path.exists(uploaded_file.file_path):
             os.remove(uploaded_file.file_path)
@@ -452,9 +618,9 @@ def delete_file(dataset_id, file_id):
         db.delete(uploaded_file)
         
         # Update dataset file count
-        dataset = db.query(Dataset).filter_by(id=dataset_id).first()
         if dataset:
             dataset.file_count = max(0, dataset.file_count - 1)
+            dataset.version = (dataset.version or 0) + 1
         
         db.commit()
         
@@ -493,6 +659,90 @@ def delete_dataset(dataset_id):
     
     return jsonify({'message': 'Dataset deleted'})
 
+# ==================== INGESTION JOB ENDPOINTS ====================
+
+# Seconds between database polls in the job progress stream
+JOB_STREAM_POLL_INTERVAL = float(os.getenv('JOB_STREAM_POLL_INTERVAL', '0.5'))
+
+@app.route('/api/jobs/<int:job_id>', methods=['GET'])
+def get_job(job_id):
+    """Get ingestion job status"""
+    db = get_db()
+    job = db.get(IngestionJob, job_id)
+    
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    return jsonify({
+        'id': job.id,
+        'dataset_id': job.dataset_id,
+        'status': job.status,
+        'total': job.total_files,
+        'processed': job.processed_count,
+        'created_at': job.created_at.isoformat(),
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+        'result': job_summary(db, job)
+    })
+
+@app.route('/api/jobs/<int:job_id>/stream', methods=['GET'])
+def stream_job(job_id):
+    """
+    Stream ingestion progress via SSE: one 'status' event per processed file, in upload
+    order, then 'final'. Reconnecting clients resume via Last-Event-ID (or ?after=<id>).
+    """
+    after = request.args.get('after', -1, type=int)
+    last_position = request.headers.get('Last-Event-ID', after, type=int)
+    
+    def generate():
+        position = last_position
+        announced = False
+        db = get_db()
+        
+        while True:
+            # End the previous read transaction so this poll sees the worker's commits
+            db.rollback()
+            job = db.get(IngestionJob, job_id)
+            
+            if not job:
+                yield sse_event('error', {'message': 'Job not found'})
+                return
+            
+            if position < 0 and not announced:
+                announced = True
+                yield sse_event('status', {'message': f'Preparing to process {job.total_files} file(s)...', 'total': job.total_files, 'processed': 0})
+            
+            # Emit files finished since the last poll, stopping at the first unfinished one
+            job_files = db.query(IngestionJobFile).filter(
+                IngestionJobFile.job_id == job_id,
+                IngestionJobFile.position > position
+            ).order_by(IngestionJobFile.position).all()
+            for job_file in job_files:
+                if job_file.status == 'pending':
+                    break
+                position = job_file.position
+                yield sse_event('status', {
+                    'message': f'Processed {job_file.filename}',
+                    'total': job.total_files,
+                    'processed': position + 1,
+                    'filename': job_file.filename,
+                    'status': job_file.status
+                }, event_id=position)
+            
+            if job.status in ('completed', 'failed'):
+                yield sse_event('final', job_summary(db, job))
+                return
+            
+            time.sleep(JOB_STREAM_POLL_INTERVAL)
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        }
+    )
+
 # ==================== CHORUS MODEL ENDPOINTS ====================
 
 @app.route('/api/chorus-models', methods=['GET'])
@@ -733,6 +983,8 @@ def chat_with_bot_stream(bot_id):
     """Stream chat responses with real-time status updates via SSE"""
     user_message = request.args.get('message', '')
     rag_count = request.args.get('rag_count', type=int)
+    stream_tokens = request.args.get('stream_tokens', 'true').lower() != 'false'
+    use_cache = response_cache.enabled and request.args.get('cache', 'true').lower() != 'false'
     
     def sse_message(event_type, data):
         """Format SSE message"""
@@ -757,12 +1009,37 @@ def chat_with_bot_stream(bot_id):
                 yield sse_message('error', {'message': 'Bot has no Chorus model configured'})
                 return
             
-            # Step 1: Classify user intent
-            from llm_service import LLMService
-            llm_service_instance = LLMService()
+            # Repeated questions against an unchanged bot and dataset are answered from cache
+            text_n_results = rag_count if rag_count is not None else (bot.rag_results_count or 50)
+            cache_key = response_cache.key(bot, chorus_model, dataset, user_message, text_n_results) if use_cache else None
+            cached = response_cache.get(db, cache_key) if cache_key else None
+            if cached:
+                yield sse_message('status', {'message': 'Answered from response cache'})
+                
+                chat_entry = ChatHistory(
+                    bot_id=bot_id,
+                    user_message=user_message,
+                    bot_response=cached['final_response']
+                )
+                db.add(chat_entry)
+                db.commit()
+                
+                yield sse_message('final', {
+                    'response': cached['final_response'],
+                    'intent': 'text',
+                    'cached': True,
+                    'debug': {
+                        'all_responses': cached['responses'],
+                        'votes': cached.get('votes'),
+                        'vote_counts': cached.get('vote_counts'),
+                        'winner_index': cached.get('winner_index')
+                    }
+                })
+                return
             
+            # Step 1: Classify user intent
             yield sse_message('status', {'message': 'Classifying user intent...'})
-            intent = llm_service_instance.classify_user_intent(user_message)
+            intent = llm_service.classify_user_intent(user_message)
             yield sse_message('status', {'message': f'Determined user inquiry as: {intent}'})
             
             # Handle different intents
@@ -773,8 +1050,9 @@ def chat_with_bot_stream(bot_id):
                 context = ""
                 if dataset:
                     relevant_docs = vector_store.query_collection(dataset.collection_name, user_message, n_results=n_results)
-                    context = "\n\n".join([f"[{doc['metadata'].get('filename', 'Unknown')}]\n{doc['text']}" for doc in relevant_docs])
-                    yield sse_message('status', {'message': f'Retrieved {len(relevant_docs)} documents'})
+                    built = context_builder.build(relevant_docs, [CHART_MODEL])
+                    context = built['text']
+                    yield sse_message('status', {'message': f"Retrieved {len(relevant_docs)} documents ({built['chunks_used']} used, {built['tokens']} tokens)"})
                 
                 yield sse_message('status', {'message': 'Analyzing data and generating chart...'})
                 chart_result = chart_generator.generate_chart(user_message, context)
@@ -788,7 +1066,7 @@ A chart has been generated showing: {chart_result['title']}
 
 Provide a brief, clear explanation of what the chart shows based on the data used."""
                 
-                explanation = llm_service_instance.call_llm('openai', 'gpt-5-2025-08-07',
+                explanation = llm_service.call_llm('openai', 'gpt-5-2025-08-07',
                                                             [{'role': 'user', 'content': explanation_prompt}])
                 
                 # Save to chat history
@@ -828,10 +1106,11 @@ Provide a brief, clear explanation of what the chart shows based on the data use
                     })
                     return
                 
-                # Search for image-related documents
+                # Search for image-related documents; candidates are filtered by type and
+                # distance below, so skip the rerank stage and keep all of them
                 n_results = rag_count if rag_count is not None else (bot.rag_results_count or 50)
                 yield sse_message('status', {'message': f'Retrieving {n_results} relevant documents...'})
-                relevant_docs = vector_store.query_collection(dataset.collection_name, user_message, n_results=n_results * 2)
+                relevant_docs = vector_store.query_collection(dataset.collection_name, user_message, n_results=n_results * 2, rerank=False)
                 
                 # Get image search settings (defaulting since they come from query params)
                 max_images = 3
@@ -921,7 +1200,7 @@ Provide a brief, clear explanation of what the chart shows based on the data use
                     
                     # Generate the image (using defaults for quality/size since they're in query params)
                     yield sse_message('status', {'message': 'Generating image with AI...'})
-                    image_result = llm_service_instance.generate_image(
+                    image_result = llm_service.generate_image(
                         prompt=user_message,
                         reference_image_path=reference_image_path,
                         quality='high',
@@ -988,35 +1267,43 @@ Provide a brief, clear explanation of what the chart shows based on the data use
             # Default: text response with Chorus
             yield sse_message('status', {'message': 'Retrieving relevant context from dataset...'})
             context = ""
-            n_results = rag_count if rag_count is not None else (bot.rag_results_count or 50)
+            n_results = text_n_results
             if dataset:
                 relevant_docs = vector_store.query_collection(dataset.collection_name, user_message, n_results=n_results)
-                context = "\n\n".join([f"[{doc['metadata'].get('filename', 'Unknown')}]\n{doc['text']}" for doc in relevant_docs])
-                yield sse_message('status', {'message': f'Retrieved {n_results} relevant context chunks'})
-            
-            # Add bot instructions to context
-            full_context = f"Bot Instructions:\n{bot.instructions}\n\n"
-            if context:
-                full_context += f"Relevant Information:\n{context}"
-            
-            # Run Chorus model - status updates will be sent via callback
-            # Use a list to collect status messages from chorus service
-            status_messages = []
-            
-            def status_callback(message):
-                status_messages.append(message)
+                # Packed to fit the smallest responder window
+                built = context_builder.build(relevant_docs, [llm['model'] for llm in chorus_model.responder_llms])
+                context = built['text']
+                yield sse_message('status', {'message': f"Retrieved {built['chunks_used']} relevant context chunks ({built['tokens']} tokens)"})
             
-            result = chorus_service.run_chorus(
+            # Run Chorus model, forwarding each status update as soon as it happens,
+            # and one responder's answer token by token as 'delta' events
+            result = None
+            streamed = False
+            for event_type, payload in chorus_service.stream_chorus(
                 user_query=user_message,
-                context=full_context,
+                context=f"Relevant Information:\n{context}" if context else "",
+                instructions=bot.instructions,
                 responder_llms=chorus_model.responder_llms,
                 evaluator_llms=chorus_model.evaluator_llms,
-                status_callback=status_callback
-            )
+                stream_tokens=stream_tokens
+            ):
+                if event_type == 'status':
+                    yield sse_message('status', {'message': payload})
+                elif event_type == 'delta':
+                    streamed = True
+                    yield sse_message('delta', payload)
+                elif event_type == 'stream_error':
+                    # The streamed draft is incomplete; the vote goes ahead without it
+                    yield sse_message('stream_error', payload)
+                else:
+                    result = payload
             
-            # Yield all status messages that were collected during chorus execution
-            for msg in status_messages:
-                yield sse_message('status', {'message': msg})
+            # The vote may have picked a different answer than the one streamed
+            if streamed:
+                yield sse_message('winner', {
+                    'winner_index': result.get('winner_index'),
+                    'response': result['final_response']
+                })
             
             # Save to chat history
             chat_entry = ChatHistory(
@@ -1025,6 +1312,8 @@ Provide a brief, clear explanation of what the chart shows based on the data use
                 bot_response=result['final_response']
             )
             db.add(chat_entry)
+            if cache_key and response_cache.cacheable(result):
+                response_cache.put(db, cache_key, bot, dataset, result)
             db.commit()
             
             # Send final response
@@ -1060,6 +1349,7 @@ def chat_with_bot(bot_id):
     user_message = data.get('message', '')
     rag_count = data.get('rag_count')  # Optional override for RAG results count
     image_settings = data.get('image_settings', {})  # Image search settings from frontend
+    use_cache = response_cache.enabled and data.get('cache', True) is not False
     
     db = get_db()
     bot = db.query(Bot).filter_by(id=bot_id).first()
@@ -1077,11 +1367,40 @@ def chat_with_bot(bot_id):
     # Track processing steps for frontend display
     processing_steps = []
     
+    # Repeated questions against an unchanged bot and dataset are answered from cache
+    text_n_results = rag_count if rag_count is not None else (bot.rag_results_count or 5)
+    cache_key = response_cache.key(bot, chorus_model, dataset, user_message, text_n_results) if use_cache else None
+    cached = response_cache.get(db, cache_key) if cache_key else None
+    if cached:
+        processing_steps.append('Answered from response cache')
+        
+        chat_entry = ChatHistory(
+            bot_id=bot_id,
+            user_message=user_message,
+            bot_response=cached['final_response']
+        )
+        db.add(chat_entry)
+        db.commit()
+        
+        return jsonify({
+            'response': cached['final_response'],
+            'intent': 'text',
+            'cached': True,
+            'rag_count_used': text_n_results,
+            'processing_steps': processing_steps,
+            'debug': {
+                'intent_detected': 'text',
+                'rag_count_used': text_n_results,
+                'all_responses': cached['responses'],
+                'votes': cached.get('votes'),
+                'vote_counts': cached.get('vote_counts'),
+                'winner_index': cached.get('winner_index')
+            }
+        })
+    
     # Step 1: Classify user intent using GPT-5
-    from llm_service import LLMService
-    llm_service_instance = LLMService()
     processing_steps.append('Classifying user intent...')
-    intent = llm_service_instance.classify_user_intent(user_message)
+    intent = llm_service.classify_user_intent(user_message)
     processing_steps.append(f'Determined user inquiry as: {intent}')
     
     print(f"User intent classified as: {intent}")
@@ -1112,10 +1431,11 @@ def chat_with_bot(bot_id):
                 }
             })
         
-        # Search for image-related documents in the vector store
+        # Search for image-related documents in the vector store; they are filtered by type
+        # and distance below, so skip the rerank stage
         n_results = rag_count if rag_count is not None else (bot.rag_results_count or 50)
         processing_steps.append(f'Retrieving {n_results} relevant documents...')
-        relevant_docs = vector_store.query_collection(dataset.collection_name, user_message, n_results=n_results * 2)
+        relevant_docs = vector_store.query_collection(dataset.collection_name, user_message, n_results=n_results * 2, rerank=False)
         
         # Get image search settings from frontend
         max_images = image_settings.get('maxResults', 3)
@@ -1205,9 +1525,10 @@ def chat_with_bot(bot_id):
             if dataset:
                 # Get relevant context from dataset
                 relevant_docs = vector_store.query_collection(dataset.collection_name, user_message, n_results=n_results)
-                context = "\n\n".join([f"[{doc['metadata'].get('filename', 'Unknown')}]\n{doc['text']}" for doc in relevant_docs])
+                built = context_builder.build(relevant_docs, [CHART_MODEL])
+                context = built['text']
                 print(f"Retrieved {len(relevant_docs)} documents for chart generation")
-                print(f"Total context length: {len(context)} characters")
+                print(f"Context: {built['chunks_used']} chunks, {built['tokens']} tokens")
             
             # Generate the chart
             processing_steps.append('Analyzing data and generating chart...')
@@ -1225,9 +1546,9 @@ Chart type: {chart_result['chart_type']}
 Provide a brief, clear explanation of what the chart shows based on the data used.
 
 Context data:
-{context[:20000]}"""
+{truncate_to_tokens(context, CHART_EXPLANATION_CONTEXT_TOKENS, CHART_MODEL)}"""
             
-            explanation = llm_service_instance.call_llm(
+            explanation = llm_service.call_llm(
                 'openai',
                 'gpt-5-2025-08-07',
                 [{'role': 'user', 'content': explanation_prompt}]
@@ -1316,7 +1637,7 @@ Context data:
             
             # Generate the image
             print(f"Generating image for prompt: {user_message}")
-            image_result = llm_service_instance.generate_image(
+            image_result = llm_service.generate_image(
                 prompt=user_message,
                 reference_image_path=reference_image_path,
                 quality=quality,
@@ -1395,16 +1716,13 @@ Context data:
     # Query vector store for relevant context
     processing_steps.append(f'Retrieving relevant context from dataset...')
     context = ""
-    n_results = rag_count if rag_count is not None else (bot.rag_results_count or 5)
+    n_results = text_n_results
     if dataset:
         relevant_docs = vector_store.query_collection(dataset.collection_name, user_message, n_results=n_results)
-        context = "\n\n".join([f"[{doc['metadata'].get('filename', 'Unknown')}]\n{doc['text']}" for doc in relevant_docs])
-        processing_steps.append(f'Retrieved {n_results} relevant context chunks')
-    
-    # Add bot instructions to context
-    full_context = f"Bot Instructions:\n{bot.instructions}\n\n"
-    if context:
-        full_context += f"Relevant Information:\n{context}"
+        # Packed to fit the smallest responder window
+        built = context_builder.build(relevant_docs, [llm['model'] for llm in chorus_model.responder_llms])
+        context = built['text']
+        processing_steps.append(f"Retrieved {built['chunks_used']} relevant context chunks ({built['tokens']} tokens)")
     
     # Run Chorus model with detailed status updates via callback
     def status_callback(message):
@@ -1412,7 +1730,8 @@ Context data:
     
     result = chorus_service.run_chorus(
         user_query=user_message,
-        context=full_context,
+        context=f"Relevant Information:\n{context}" if context else "",
+        instructions=bot.instructions,
         responder_llms=chorus_model.responder_llms,
         evaluator_llms=chorus_model.evaluator_llms,
         status_callback=status_callback
@@ -1425,6 +1744,8 @@ Context data:
         bot_response=result['final_response']
     )
     db.add(chat_entry)
+    if cache_key and response_cache.cacheable(result):
+        response_cache.put(db, cache_key, bot, dataset, result)
     db.commit()
     
     return jsonify({
@@ -1444,16 +1765,28 @@ Context data:
 
 @app.route('/api/bots/<int:bot_id>/history', methods=['GET'])
 def get_chat_history(bot_id):
-    """Get chat history for a bot"""
+    """
+    Get the latest page of a bot's chat history, oldest first
+    Older pages are fetched with ?before=<id>&limit=<n>, using the cursor returned in the
+    X-Next-Before header; ?all=true returns the whole history
+    """
     db = get_db()
-    history = db.query(ChatHistory).filter_by(bot_id=bot_id).order_by(ChatHistory.created_at).all()
+    history_query = db.query(ChatHistory).filter_by(bot_id=bot_id)
+    next_before = None
+    if wants_all_rows():
+        history = history_query.order_by(ChatHistory.id).all()
+    else:
+        history, next_before = paginate(history_query, ChatHistory.id)
     
-    return jsonify([{
+    response = jsonify([{
         'id': h.id,
         'user_message': h.user_message,
         'bot_response': h.bot_response,
         'created_at': h.created_at.isoformat()
     } for h in history])
+    if next_before is not None:
+        response.headers['X-Next-Before'] = str(next_before)
+    return response
 
 @app.route('/api/bots/<int:bot_id>/history', methods=['DELETE'])
 def clear_chat_history(bot_id):
@@ -1481,6 +1814,17 @@ def health_check():
         'timestamp': datetime.now(UTC).isoformat()
     })
 
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """Cache and performance counters"""
+    return jsonify({
+        'embedding_cache': vector_store.cache_stats(),
+        'prompt_cache': llm_service.prompt_cache_stats(),
+        'response_cache': response_cache.stats(),
+        'intent_classifier': llm_service.intent_classifier.stats(),
+        'timestamp': datetime.now(UTC).isoformat()
+    })
+
 @app.route('/api/generated-images/<path:filename>', methods=['GET'])
 def serve_generated_image(filename):
     """Serve generated images"""
@@ -1499,5 +1843,10 @@ def serve_generated_chart(filename):
         return jsonify({'error': str(e)}), 404
 
 if __name__ == '__main__':
-    app.run(debug=True, port=5000)
+    # The debug reloader runs this block in a watcher process too; only the serving
+    # child (WERKZEUG_RUN_MAIN) should open the stores and start background threads
+    debug = True
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        create_app()
+    app.run(debug=debug, port=5000)
 
@@ -6,11 +6,16 @@ import numpy as np
 from datetime import datetime
 import os
 import uuid
-from llm_service import LLMService
+from llm_service import get_llm_service
+from context_builder import ContextBuilder, truncate_to_tokens
+
+CHART_MODEL = "gpt-5-2025-08-07"
 
 class ChartGenerator:
     def __init__(self):
-        self.llm_service = LLMService()
+        self.llm_service = get_llm_service()
+        # Callers pass context packed by ContextBuilder; this only guards oversized strings
+        self.max_context_tokens = ContextBuilder().budget([CHART_MODEL])
         self.charts_folder = 'generated_charts'
         os.makedirs(self.charts_folder, exist_ok=True)
     
@@ -48,7 +53,7 @@ class ChartGenerator:
 User Query: {user_query}
 
 Context Data:
-{context[:50000]}
+{truncate_to_tokens(context, self.max_context_tokens, CHART_MODEL)}
 
 CRITICAL INSTRUCTIONS:
 1. READ THROUGH THE ENTIRE CONTEXT - there are multiple data entries/documents
@@ -84,7 +89,7 @@ EXAMPLE - If data shows spend across months:
 }}"""
 
         response = self.llm_service.openai_client.chat.completions.create(
-            model="gpt-5-2025-08-07",
+            model=CHART_MODEL,
             messages=[
                 {"role": "system", "content": "You are a data visualization expert. Extract chart specifications from the provided data and return them in JSON format."},
                 {"role": "user", "content": prompt}
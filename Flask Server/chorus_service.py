@@ -1,12 +1,116 @@
-from llm_service import LLMService
+from llm_service import get_llm_service
 from typing import List, Dict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import json
+import os
+import queue
+import threading
+
+RESPONDER_SYSTEM_PROMPT = "You are a helpful assistant. Use the provided context to answer the user's question."
+EVALUATOR_SYSTEM_PROMPT = """You are an expert response evaluator. You will be given a question and several different responses to it.
+
+Evaluate all responses and select the BEST one based on:
+- Accuracy and relevance to the question
+- Use of provided context
+- Clarity and completeness
+- Helpfulness"""
+
+def build_responder_messages(user_query: str, context: str, instructions: str = None) -> list:
+    """
+    Responder prompt, shared by every responder in a run
+    Ordered from most to least stable (system + bot instructions, retrieved context, question)
+    so providers can reuse the cached prefix across responders and across turns. Messages
+    flagged "cache" become Anthropic cache breakpoints; OpenAI caches the prefix automatically.
+    """
+    system = RESPONDER_SYSTEM_PROMPT
+    if instructions:
+        system += f"\n\nBot Instructions:\n{instructions}"
+    
+    messages = [{"role": "system", "content": system, "cache": True}]
+    if context:
+        messages.append({"role": "user", "content": f"Context:\n{context}", "cache": True})
+    messages.append({"role": "user", "content": f"Question: {user_query}"})
+    return messages
+
+def build_evaluator_messages(user_query: str, responses: List[Dict]) -> list:
+    """Evaluator prompt, shared by every evaluator in a run"""
+    # Format responses for evaluation
+    responses_text = "\n\n".join([
+        f"Response {r['index']} (from {r['provider']} {r['model']}):\n{r['response']}"
+        for r in responses
+    ])
+    
+    return [
+        {"role": "system", "content": EVALUATOR_SYSTEM_PROMPT, "cache": True},
+        {"role": "user", "content": f"Question: {user_query}\n\n{responses_text}", "cache": True},
+        {"role": "user", "content": "Respond with ONLY the number (index) of the best response. Just the number, nothing else."}
+    ]
 
 class ChorusService:
-    def __init__(self):
-        self.llm_service = LLMService()
+    def __init__(self, max_concurrency: int = None):
+        self.llm_service = get_llm_service()
+        # Cap on simultaneous provider calls per chorus run (1 = sequential)
+        self.max_concurrency = max_concurrency or int(os.getenv('CHORUS_MAX_CONCURRENCY', '8'))
+        self.evaluator_quorum = os.getenv('CHORUS_EVALUATOR_QUORUM', 'false').lower() in ('1', 'true', 'yes')
+        # Which responder's tokens are streamed: 'fastest' or a responder index
+        stream_responder = os.getenv('CHORUS_STREAM_RESPONDER', 'fastest')
+        self.stream_responder = None if stream_responder == 'fastest' else int(stream_responder)
     
-    def run_chorus(self, user_query: str, context: str, responder_llms: List[Dict], evaluator_llms: List[Dict], status_callback=None) -> Dict:
+    def stream_chorus(self, user_query: str, context: str, responder_llms: List[Dict], evaluator_llms: List[Dict], quorum: bool = None, stream_tokens: bool = False, instructions: str = None):
+        """
+        Run the Chorus model in a background thread and yield progress as it happens
+        Yields ('status', message) for every status update, then ('result', result)
+        where result is the run_chorus return value.
+        With stream_tokens, one responder's answer is also yielded as it is generated:
+        ('delta', {'index', 'provider', 'model', 'text'})
+        and, if that responder fails part way, ('stream_error', {'index', 'provider', 'model', 'error'})
+        """
+        events = queue.Queue()
+        
+        def on_delta(index, text):
+            events.put(('delta', {
+                'index': index,
+                'provider': responder_llms[index]['provider'],
+                'model': responder_llms[index]['model'],
+                'text': text
+            }))
+        
+        def on_stream_error(index, error):
+            events.put(('stream_error', {
+                'index': index,
+                'provider': responder_llms[index]['provider'],
+                'model': responder_llms[index]['model'],
+                'error': error
+            }))
+        
+        def worker():
+            try:
+                result = self.run_chorus(
+                    user_query=user_query,
+                    context=context,
+                    responder_llms=responder_llms,
+                    evaluator_llms=evaluator_llms,
+                    status_callback=lambda message: events.put(('status', message)),
+                    quorum=quorum,
+                    delta_callback=on_delta if stream_tokens else None,
+                    stream_error_callback=on_stream_error if stream_tokens else None,
+                    instructions=instructions
+                )
+                events.put(('result', result))
+            except Exception as e:
+                events.put(('error', e))
+        
+        threading.Thread(target=worker, daemon=True).start()
+        
+        while True:
+            event_type, payload = events.get()
+            if event_type == 'error':
+                raise payload
+            yield event_type, payload
+            if event_type == 'result':
+                return
+    
+    def run_chorus(self, user_query: str, context: str, responder_llms: List[Dict], evaluator_llms: List[Dict], status_callback=None, quorum: bool = None, delta_callback=None, stream_responder: int = None, instructions: str = None, stream_error_callback=None) -> Dict:
         """
         Run the Chorus model:
         1. Get responses from all responder LLMs
@@ -15,100 +119,137 @@ class ChorusService:
         
         responder_llms: [{"provider": "openai", "model": "gpt-4"}]
         evaluator_llms: [{"provider": "anthropic", "model": "claude-3-sonnet"}]
+        quorum: stop waiting for evaluators once one response has an unbeatable lead
+                (defaults to the CHORUS_EVALUATOR_QUORUM setting)
+        delta_callback: called as delta_callback(index, text) with the tokens of one responder,
+                        the designated stream_responder or else whichever starts answering first
+        instructions: bot instructions, kept in the system prompt ahead of the retrieved context
+        stream_error_callback: called as stream_error_callback(index, error) when the streamed
+                               responder fails after some of its tokens were sent
+        
+        A responder whose stream fails is kept in 'responses' with 'failed': True and is
+        left out of the vote.
         """
+        if quorum is None:
+            quorum = self.evaluator_quorum
+        if stream_responder is None:
+            stream_responder = self.stream_responder
+        stream_owner = _StreamOwner(stream_responder)
         
-        # Step 1: Get responses from all responder LLMs
+        # Step 1: Get responses from all responder LLMs concurrently
         print(f"Getting responses from {len(responder_llms)} responder LLMs...")
-        responses = []
+        # Built once and shared by all responders (and their provider-side prompt caches)
+        messages = build_responder_messages(user_query, context, instructions)
+        responses = [None] * len(responder_llms)
         
-        for i, llm_config in enumerate(responder_llms):
-            if status_callback:
-                status_callback(f'Getting response from responder {i + 1}/{len(responder_llms)}...')
-            
-            messages = [
-                {"role": "system", "content": "You are a helpful assistant. Use the provided context to answer the user's question."},
-                {"role": "user", "content": f"Context:\n{context}\n\nQuestion: {user_query}"}
-            ]
-            
-            response = self.llm_service.call_llm(
-                provider=llm_config['provider'],
-                model=llm_config['model'],
-                messages=messages
-            )
-            
-            responses.append({
-                'index': i,
-                'provider': llm_config['provider'],
-                'model': llm_config['model'],
-                'response': response
-            })
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_concurrency, len(responder_llms)))) as executor:
+            futures = {}
+            for i, llm_config in enumerate(responder_llms):
+                if status_callback:
+                    status_callback(f'Getting response from responder {i + 1}/{len(responder_llms)}...')
+                
+                future = executor.submit(self._get_response, i, llm_config, messages, delta_callback, stream_owner)
+                futures[future] = i
             
-            if status_callback:
-                status_callback(f'Received response from {llm_config["provider"]} {llm_config["model"]}')
+            # Status events are emitted from this thread as responders finish
+            for future in as_completed(futures):
+                i = futures[future]
+                llm_config = responder_llms[i]
+                try:
+                    response_text, failed = future.result(), False
+                except Exception as e:
+                    response_text, failed = f"Error: {str(e)}", True
+                    if stream_error_callback and stream_owner.owner == i:
+                        stream_error_callback(i, str(e))
+                
+                responses[i] = {
+                    'index': i,
+                    'provider': llm_config['provider'],
+                    'model': llm_config['model'],
+                    'response': response_text,
+                    'failed': failed
+                }
+                
+                if status_callback:
+                    if failed:
+                        status_callback(f'Responder {llm_config["provider"]} {llm_config["model"]} failed')
+                    else:
+                        status_callback(f'Received response from {llm_config["provider"]} {llm_config["model"]}')
         
-        # If only one responder, return it directly
-        if len(responses) == 1:
+        # Only complete answers are put to the evaluators
+        candidates = [r for r in responses if not r['failed']]
+        
+        # If only one answer (or none) is left, return it directly
+        if len(candidates) <= 1:
+            winner = candidates[0] if candidates else responses[0]
             return {
-                'final_response': responses[0]['response'],
+                'final_response': winner['response'],
                 'responses': responses,
                 'votes': None,
-                'winner_index': 0
+                'winner_index': winner['index']
             }
         
         # Step 2: Have evaluators vote on the best response
         print(f"Getting votes from {len(evaluator_llms)} evaluator LLMs...")
         if status_callback:
             status_callback(f'Evaluating responses with {len(evaluator_llms)} evaluator(s)...')
-        votes = []
         
-        # Format responses for evaluation
-        responses_text = "\n\n".join([
-            f"Response {r['index']} (from {r['provider']} {r['model']}):\n{r['response']}"
-            for r in responses
-        ])
+        messages = build_evaluator_messages(user_query, candidates)
+        candidate_indexes = {r['index'] for r in candidates}
         
-        for idx, evaluator in enumerate(evaluator_llms):
-            if status_callback:
-                status_callback(f'Getting vote from evaluator {idx + 1}/{len(evaluator_llms)}...')
-            
-            evaluation_prompt = f"""You are an expert evaluator. Below are {len(responses)} different responses to the same question.
-
-Question: {user_query}
-
-{responses_text}
-
-Evaluate all responses and select the BEST one based on:
-- Accuracy and relevance to the question
-- Use of provided context
-- Clarity and completeness
-- Helpfulness
-
-Respond with ONLY the number (index) of the best response. Just the number, nothing else."""
-
-            messages = [
-                {"role": "system", "content": "You are an expert response evaluator."},
-                {"role": "user", "content": evaluation_prompt}
-            ]
-            
-            vote = self.llm_service.call_llm(
-                provider=evaluator['provider'],
-                model=evaluator['model'],
-                messages=messages,
-                temperature=0.3
-            )
+        # Votes are collected per evaluator slot so the tally stays in evaluator order
+        evaluator_votes = [None] * len(evaluator_llms)
+        vote_counts = {}
+        pending = len(evaluator_llms)
+        quorum_reached = False
+        
+        executor = ThreadPoolExecutor(max_workers=max(1, min(self.max_concurrency, len(evaluator_llms))))
+        try:
+            futures = {}
+            for idx, evaluator in enumerate(evaluator_llms):
+                if status_callback:
+                    status_callback(f'Getting vote from evaluator {idx + 1}/{len(evaluator_llms)}...')
+                
+                future = executor.submit(
+                    self.llm_service.call_llm,
+                    provider=evaluator['provider'],
+                    model=evaluator['model'],
+                    messages=messages,
+                    temperature=0.3
+                )
+                futures[future] = idx
             
-            # Extract vote number
-            try:
-                vote_index = int(vote.strip())
-                if 0 <= vote_index < len(responses):
-                    votes.append({
-                        'evaluator': f"{evaluator['provider']} {evaluator['model']}",
-                        'vote': vote_index
-                    })
+            for future in as_completed(futures):
+                idx = futures[future]
+                evaluator = evaluator_llms[idx]
+                vote = future.result()
+                pending -= 1
+                
+                # Extract vote number
+                try:
+                    vote_index = int(vote.strip())
+                    if vote_index in candidate_indexes:
+                        evaluator_votes[idx] = {
+                            'evaluator': f"{evaluator['provider']} {evaluator['model']}",
+                            'vote': vote_index
+                        }
+                        vote_counts[vote_index] = vote_counts.get(vote_index, 0) + 1
+                        if status_callback:
+                            status_callback(f'{evaluator["provider"]} {evaluator["model"]} voted for Response {vote_index + 1}')
+                except:
+                    print(f"Invalid vote received: {vote}")
+                
+                if quorum and pending and self._is_decided(vote_counts, pending):
+                    quorum_reached = True
+                    print(f"Quorum reached, ignoring {pending} outstanding evaluator(s)")
                     if status_callback:
-                        status_callback(f'{evaluator["provider"]} {evaluator["model"]} voted for Response {vote_index + 1}')
-            except:
-                print(f"Invalid vote received: {vote}")
+                        status_callback(f'Quorum reached, skipping {pending} remaining evaluator(s)')
+                    break
+        finally:
+            # Drop queued evaluator calls; in-flight ones finish in the background and are ignored
+            executor.shutdown(wait=not quorum_reached, cancel_futures=True)
+        
+        votes = [v for v in evaluator_votes if v is not None]
         
         # Step 3: Count votes and determine winner
         vote_counts = {}
@@ -120,14 +261,56 @@ Respond with ONLY the number (index) of the best response. Just the number, noth
         if vote_counts:
             winner_index = max(vote_counts, key=vote_counts.get)
         else:
-            # Fallback: return first response if no valid votes
-            winner_index = 0
+            # Fallback: return first complete response if no valid votes
+            winner_index = candidates[0]['index']
         
         return {
             'final_response': responses[winner_index]['response'],
             'responses': responses,
             'votes': votes,
             'vote_counts': vote_counts,
-            'winner_index': winner_index
+            'winner_index': winner_index,
+            'quorum_reached': quorum_reached
         }
+    
+    def _get_response(self, index: int, llm_config: Dict, messages: list, delta_callback=None, stream_owner=None) -> str:
+        """Get one responder's answer, streaming its tokens if it owns the stream"""
+        if delta_callback is None:
+            return self.llm_service.call_llm(
+                provider=llm_config['provider'],
+                model=llm_config['model'],
+                messages=messages
+            )
+        
+        parts = []
+        for text in self.llm_service.stream_llm(
+            provider=llm_config['provider'],
+            model=llm_config['model'],
+            messages=messages
+        ):
+            parts.append(text)
+            if stream_owner.claim(index):
+                delta_callback(index, text)
+        return ''.join(parts)
+    
+    @staticmethod
+    def _is_decided(vote_counts: Dict, remaining: int) -> bool:
+        """True when the leading response cannot be caught by the remaining votes"""
+        if not vote_counts:
+            return False
+        ranked = sorted(vote_counts.values(), reverse=True)
+        runner_up = ranked[1] if len(ranked) > 1 else 0
+        return ranked[0] > runner_up + remaining
+
 
+class _StreamOwner:
+    """Decides which responder's tokens get streamed: a fixed index or the first to claim"""
+    def __init__(self, owner: int = None):
+        self.owner = owner
+        self._lock = threading.Lock()
+    
+    def claim(self, index: int) -> bool:
+        with self._lock:
+            if self.owner is None:
+                self.owner = index
+            return self.owner == index
@@ -0,0 +1,108 @@
+import os
+import re
+from typing import List, Dict, Tuple
+from token_utils import count_tokens
+
+WORD_PATTERN = re.compile(r'\S+\s*')
+MARKDOWN_HEADING_PATTERN = re.compile(r'^#{1,6}\s+(.+?)\s*#*\s*$', re.MULTILINE)
+
+def markdown_sections(text: str) -> List[Tuple[int, int, str]]:
+    """Split markdown into (start, end, heading) spans, one per heading"""
+    starts = [(m.start(), m.group(1)) for m in MARKDOWN_HEADING_PATTERN.finditer(text)]
+    if not starts or starts[0][0] > 0:
+        starts.insert(0, (0, None))
+    return [
+        (start, starts[i + 1][0] if i + 1 < len(starts) else len(text), heading)
+        for i, (start, heading) in enumerate(starts)
+    ]
+
+class TextChunker:
+    """
+    Token-bounded chunker
+    Text is cut into windows of at most chunk_tokens with overlap_tokens of overlap.
+    When sections are given (headings, paragraphs), small consecutive sections are packed
+    together and only sections larger than a chunk are windowed.
+    """
+    def __init__(self, chunk_tokens: int = None, overlap_tokens: int = None, model: str = None):
+        self.chunk_tokens = chunk_tokens or int(os.getenv('CHUNK_TOKENS', '512'))
+        self.overlap_tokens = overlap_tokens if overlap_tokens is not None else int(os.getenv('CHUNK_OVERLAP_TOKENS', '64'))
+        self.model = model
+    
+    def chunk(self, text: str, sections: List[Tuple[int, int, str]] = None) -> List[Dict]:
+        """
+        Chunk text, optionally along section boundaries
+        Returns: [{"text": str, "char_start": int, "char_end": int, "heading": str or None}]
+        """
+        if sections is None:
+            sections = [(0, len(text), None)]
+        
+        chunks = []
+        packed = []  # (start, end, heading) of sections waiting to be emitted together
+        packed_tokens = 0
+        
+        def flush():
+            nonlocal packed, packed_tokens
+            if packed:
+                self._append(chunks, text, packed[0][0], packed[-1][1], packed[0][2])
+            packed = []
+            packed_tokens = 0
+        
+        for start, end, heading in sections:
+            if not text[start:end].strip():
+                continue
+            tokens = count_tokens(text[start:end], self.model)
+            
+            if tokens > self.chunk_tokens:
+                flush()
+                for window_start, window_end in self._windows(text, start, end):
+                    self._append(chunks, text, window_start, window_end, heading)
+            else:
+                if packed_tokens + tokens > self.chunk_tokens:
+                    flush()
+                packed.append((start, end, heading))
+                packed_tokens += tokens
+        
+        flush()
+        return chunks
+    
+    def _windows(self, text: str, start: int, end: int) -> List[Tuple[int, int]]:
+        """Overlapping token windows over text[start:end], cut on word boundaries"""
+        units = [
+            (start + m.start(), start + m.end(), count_tokens(m.group(), self.model))
+            for m in WORD_PATTERN.finditer(text[start:end])
+        ]
+        
+        windows = []
+        i = 0
+        while i < len(units):
+            j = i
+            tokens = 0
+            while j < len(units) and (j == i or tokens + units[j][2] <= self.chunk_tokens):
+                tokens += units[j][2]
+                j += 1
+            windows.append((units[i][0], units[j - 1][1]))
+            if j >= len(units):
+                break
+            
+            # Step back over trailing words to build the overlap, always moving forward
+            k = j
+            overlap = 0
+            while k - 1 > i and overlap + units[k - 1][2] <= self.overlap_tokens:
+                k -= 1
+                overlap += units[k][2]
+            i = k
+        return windows
+    
+    @staticmethod
+    def _append(chunks: List[Dict], text: str, start: int, end: int, heading: str):
+        # Trim surrounding whitespace while keeping offsets exact
+        segment = text[start:end]
+        start += len(segment) - len(segment.lstrip())
+        end -= len(segment) - len(segment.rstrip())
+        if start < end:
+            chunks.append({
+                "text": text[start:end],
+                "char_start": start,
+                "char_end": end,
+                "heading": heading
+            })
@@ -0,0 +1,137 @@
+import os
+from typing import List, Dict
+from token_utils import count_tokens, get_encoding
+
+# Context windows (tokens) by model name prefix; the longest matching prefix wins
+MODEL_CONTEXT_WINDOWS = {
+    'gpt-5': 400000,
+    'gpt-4.1': 1000000,
+    'gpt-4o': 128000,
+    'gpt-4-turbo': 128000,
+    'gpt-4': 8192,
+    'gpt-3.5': 16385,
+    'o1': 200000,
+    'o3': 200000,
+    'o4': 200000,
+    'claude': 200000,
+    'llama-3.1': 131072,
+    'llama-3.3': 131072,
+    'llama3': 8192,
+    'mixtral': 32768,
+    'gemma': 8192,
+}
+DEFAULT_CONTEXT_WINDOW = 32768
+
+def context_window(model: str = None) -> int:
+    """Context window for a model name (conservative default for unknown models)"""
+    if not model:
+        return DEFAULT_CONTEXT_WINDOW
+    matches = [prefix for prefix in MODEL_CONTEXT_WINDOWS if model.lower().startswith(prefix)]
+    return MODEL_CONTEXT_WINDOWS[max(matches, key=len)] if matches else DEFAULT_CONTEXT_WINDOW
+
+def truncate_to_tokens(text: str, max_tokens: int, model: str = None) -> str:
+    """Cut text to at most max_tokens for a model"""
+    if count_tokens(text, model) <= max_tokens:
+        return text
+    encoding = get_encoding(model)
+    if encoding is None:
+        return text[:max_tokens * 4]
+    return encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
+
+class ContextBuilder:
+    """
+    Builds the retrieved-context block sent to LLMs
+    Chunks are taken in relevance order, overlapping or duplicate chunks are dropped (or
+    trimmed to their new text), and chunks are packed until the target model's budget is
+    used. The budget is the smaller of max_tokens and a fraction of the model's window,
+    leaving room for instructions, the question and the answer.
+    """
+    def __init__(self, max_tokens: int = None, window_fraction: float = None):
+        self.max_tokens = max_tokens or int(os.getenv('CONTEXT_MAX_TOKENS', '12000'))
+        self.window_fraction = window_fraction or float(os.getenv('CONTEXT_WINDOW_FRACTION', '0.5'))
+    
+    def budget(self, models: List[str] = None, max_tokens: int = None) -> int:
+        """Token budget that fits every target model"""
+        budget = max_tokens or self.max_tokens
+        for model in models or [None]:
+            budget = min(budget, int(context_window(model) * self.window_fraction))
+        return budget
+    
+    def build(self, docs: List[Dict], models: List[str] = None, max_tokens: int = None) -> Dict:
+        """
+        Pack retrieved docs into one context string
+        docs: [{"text", "metadata"}] in relevance order
+        models: target model names; tokens are counted for the first and the budget fits all
+        Returns: {"text", "tokens", "budget", "chunks_used", "chunks_total", "duplicates"}
+        """
+        budget = self.budget(models, max_tokens)
+        model = models[0] if models else None
+        separator_tokens = count_tokens('\n\n', model)
+        
+        blocks = []
+        spans = {}  # (file, page) -> [(char_start, char_end)] already included
+        seen_texts = set()
+        duplicates = 0
+        used = 0
+        
+        for doc in docs:
+            metadata = doc.get('metadata') or {}
+            text = self._new_text(doc['text'], metadata, spans)
+            if text is None or text.strip() in seen_texts:
+                duplicates += 1
+                continue
+            
+            block = f"[{metadata.get('filename', 'Unknown')}]\n{text}"
+            tokens = count_tokens(block, model) + (separator_tokens if blocks else 0)
+            if used + tokens > budget:
+                # Keep scanning: a smaller, less relevant chunk may still fit
+                continue
+            
+            blocks.append(block)
+            seen_texts.add(text.strip())
+            used += tokens
+            self._record_span(metadata, spans)
+        
+        return {
+            'text': '\n\n'.join(blocks),
+            'tokens': used,
+            'budget': budget,
+            'chunks_used': len(blocks),
+            'chunks_total': len(docs),
+            'duplicates': duplicates
+        }
+    
+    @staticmethod
+    def _span_key(metadata: Dict):
+        if 'char_start' not in metadata or 'char_end' not in metadata:
+            return None
+        return (metadata.get('file_key') or metadata.get('filename'), metadata.get('page'))
+    
+    def _new_text(self, text: str, metadata: Dict, spans: Dict) -> str:
+        """
+        Part of a chunk not already covered by included chunks of the same file/page
+        Chunk text is the exact [char_start, char_end) slice, so overlap from neighbouring
+        windows can be trimmed off. Returns None when the chunk adds nothing.
+        """
+        key = self._span_key(metadata)
+        if key is None or key not in spans:
+            return text
+        
+        start, end = metadata['char_start'], metadata['char_end']
+        if len(text) != end - start:
+            return text
+        for included_start, included_end in spans[key]:
+            if included_start <= start and end <= included_end:
+                return None
+            if included_start <= start < included_end:
+                text = text[included_end - start:]
+                start = included_end
+            elif start < included_start < end <= included_end:
+                text = text[:included_start - start]
+                end = included_start
+        return text if text.strip() else None
+    
+    def _record_span(self, metadata: Dict, spans: Dict):
+        key = self._span_key(metadata)
+        if key is not None:
+            spans.setdefault(key, []).append((metadata['char_start'], metadata['char_end']))
@@ -0,0 +1,166 @@
+import sqlite3
+import threading
+import hashlib
+import time
+import os
+from array import array
+from collections import OrderedDict
+from typing import List, Dict
+
+class EmbeddingCache:
+    """
+    Persistent embedding cache keyed by (model, sha256 of text)
+    Entries live in a local SQLite file; the least recently used ones are evicted once
+    the cache grows past max_entries.
+    """
+    def __init__(self, path: str = None, max_entries: int = None):
+        self.path = path or os.getenv('EMBEDDING_CACHE_PATH', './embedding_cache.db')
+        self.max_entries = max_entries or int(os.getenv('EMBEDDING_CACHE_MAX_ENTRIES', '200000'))
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                text_hash TEXT NOT NULL,
+                embedding BLOB NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (model, text_hash)
+            )
+        ''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS ix_embeddings_last_used ON embeddings (last_used)')
+        self._conn.commit()
+        self._size = self._conn.execute('SELECT COUNT(*) FROM embeddings').fetchone()[0]
+    
+    @staticmethod
+    def text_hash(text: str) -> str:
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+    
+    def get_many(self, model: str, texts: List[str]) -> Dict[str, List[float]]:
+        """Look up texts, returning {text_hash: embedding} for the ones that are cached"""
+        hashes = list({self.text_hash(text) for text in texts})
+        found = {}
+        
+        with self._lock:
+            # Stay well under SQLite's bound-parameter limit
+            for i in range(0, len(hashes), 500):
+                chunk = hashes[i:i + 500]
+                placeholders = ','.join('?' * len(chunk))
+                rows = self._conn.execute(
+                    f'SELECT text_hash, embedding FROM embeddings WHERE model = ? AND text_hash IN ({placeholders})',
+                    [model] + chunk
+                ).fetchall()
+                for text_hash, blob in rows:
+                    found[text_hash] = array('f', blob).tolist()
+            
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    'UPDATE embeddings SET last_used = ? WHERE model = ? AND text_hash = ?',
+                    [(now, model, text_hash) for text_hash in found]
+                )
+                self._conn.commit()
+            
+            for text in texts:
+                if self.text_hash(text) in found:
+                    self.hits += 1
+                else:
+                    self.misses += 1
+        
+        return found
+    
+    def put_many(self, model: str, texts: List[str], embeddings: List[List[float]]):
+        """Store embeddings for texts, evicting least recently used entries if over capacity"""
+        now = time.time()
+        rows = [
+            (model, self.text_hash(text), array('f', embedding).tobytes(), now)
+            for text, embedding in zip(texts, embeddings)
+        ]
+        
+        with self._lock:
+            before = self._conn.total_changes
+            self._conn.executemany(
+                'INSERT OR IGNORE INTO embeddings (model, text_hash, embedding, last_used) VALUES (?, ?, ?, ?)',
+                rows
+            )
+            self._size += self._conn.total_changes - before
+            
+            if self._size > self.max_entries:
+                # Trim to 90% so eviction doesn't run on every insert
+                excess = self._size - int(self.max_entries * 0.9)
+                self._conn.execute(
+                    'DELETE FROM embeddings WHERE rowid IN (SELECT rowid FROM embeddings ORDER BY last_used LIMIT ?)',
+                    (excess,)
+                )
+                self._size -= excess
+                self.evictions += excess
+            
+            self._conn.commit()
+    
+    def stats(self) -> Dict:
+        """Hit/miss counters and current size"""
+        lookups = self.hits + self.misses
+        return {
+            'entries': self._size,
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
+
+
+class QueryEmbeddingCache:
+    """
+    In-process LRU cache with a TTL for query embeddings
+    Sits in front of the embedding API (and the persistent cache) for chat queries.
+    """
+    def __init__(self, max_entries: int = None, ttl_seconds: float = None):
+        self.max_entries = max_entries or int(os.getenv('QUERY_EMBEDDING_CACHE_SIZE', '2048'))
+        self.ttl_seconds = ttl_seconds or float(os.getenv('QUERY_EMBEDDING_CACHE_TTL', '3600'))
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self._entries = OrderedDict()  # (model, text) -> (expires_at, embedding)
+        self._lock = threading.Lock()
+    
+    def get(self, model: str, text: str) -> List[float]:
+        """Return the cached embedding, or None on a miss or expired entry"""
+        key = (model, text)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+    
+    def put(self, model: str, text: str, embedding: List[float]):
+        with self._lock:
+            self._entries[(model, text)] = (time.monotonic() + self.ttl_seconds, embedding)
+            self._entries.move_to_end((model, text))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+    
+    def stats(self) -> Dict:
+        """Hit/miss counters and current size"""
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'max_entries': self.max_entries,
+            'ttl_seconds': self.ttl_seconds,
+            'hits': self.hits,
+            'misses': self.misses,
+            'expirations': self.expirations,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
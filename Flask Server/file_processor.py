@@ -1,20 +1,50 @@
 import os
-from PIL import Image
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import pytesseract
 import PyPDF2
 from docx import Document
-from typing import List, Dict
-from llm_service import LLMService
+from typing import List, Dict, Tuple
+from llm_service import get_llm_service
+from chunker import TextChunker, markdown_sections
+from image_utils import load_image, ocr_image, vision_jpeg
+from pdf_utils import configure_tesseract, extract_pdf_pages
+
+# PDFs with at least this many pages are split across processes
+PDF_PARALLEL_MIN_PAGES = int(os.getenv('PDF_PARALLEL_MIN_PAGES', '32'))
+PDF_PAGES_PER_TASK = int(os.getenv('PDF_PAGES_PER_TASK', '16'))
 
 class FileProcessor:
-    def __init__(self):
-        self.llm_service = LLMService()
+    def __init__(self, chunk_tokens: int = None, overlap_tokens: int = None, pdf_processes: int = None):
+        self.llm_service = get_llm_service()
+        self.chunker = TextChunker(chunk_tokens, overlap_tokens)
+        self.pdf_processes = pdf_processes or int(os.getenv('PDF_EXTRACT_PROCESSES', str(os.cpu_count() or 1)))
+        self._pdf_pool = None
+        self._pdf_pool_lock = threading.Lock()
+        # Vision requests run here so they overlap with OCR on the calling thread
+        self._description_pool = ThreadPoolExecutor(max_workers=int(os.getenv('IMAGE_DESCRIPTION_WORKERS', '4')))
         
-        # Set Tesseract path for Windows if not in PATH
-        if os.name == 'nt':  # Windows
-            tesseract_path = r'C:\Program Files\Tesseract-OCR\tesseract.exe'
-            if os.path.exists(tesseract_path):
-                pytesseract.pytesseract.tesseract_cmd = tesseract_path
+        configure_tesseract()
+    
+    def _get_pdf_pool(self) -> ProcessPoolExecutor:
+        """
+        Process pool for page extraction, created on first large PDF
+        Workers are always spawned: forking the multithreaded server can deadlock, and
+        spawned workers only import pdf_utils (plus the guarded main module).
+        """
+        with self._pdf_pool_lock:
+            if self._pdf_pool is None:
+                self._pdf_pool = ProcessPoolExecutor(max_workers=self.pdf_processes, mp_context=multiprocessing.get_context('spawn'))
+            return self._pdf_pool
+    
+    def _discard_pdf_pool(self, pool: ProcessPoolExecutor):
+        """Drop a broken pool so the next large PDF starts a fresh one"""
+        with self._pdf_pool_lock:
+            if self._pdf_pool is pool:
+                self._pdf_pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
     
     def process_file(self, file_path: str, filename: str) -> List[Dict]:
         """
@@ -36,46 +66,86 @@ class FileProcessor:
         else:
             return [{"text": f"Unsupported file type: {file_extension}", "metadata": {"filename": filename, "type": "error"}}]
     
+    def _chunk(self, text: str, metadata: Dict, sections=None) -> List[Dict]:
+        """
+        Split text into token-bounded chunks
+        Each chunk's metadata gets chunk_index and its char_start/char_end in text
+        """
+        documents = []
+        for i, chunk in enumerate(self.chunker.chunk(text, sections)):
+            chunk_metadata = dict(metadata)
+            chunk_metadata.update({
+                "chunk_index": i,
+                "char_start": chunk['char_start'],
+                "char_end": chunk['char_end']
+            })
+            if chunk['heading']:
+                chunk_metadata["heading"] = chunk['heading']
+            documents.append({"text": chunk['text'], "metadata": chunk_metadata})
+        return documents
+    
+    def _number_chunks(self, documents: List[Dict]) -> List[Dict]:
+        """Renumber chunk_index across a whole file and record total_chunks"""
+        for i, doc in enumerate(documents):
+            doc['metadata']['chunk_index'] = i
+            doc['metadata']['total_chunks'] = len(documents)
+        return documents
+    
     def _process_text(self, file_path: str, filename: str) -> List[Dict]:
         """Process plain text file"""
         try:
             with open(file_path, 'r', encoding='utf-8') as f:
                 content = f.read()
             
-            return [{
-                "text": content,
-                "metadata": {
-                    "filename": filename,
-                    "type": "text",
-                    "size": len(content)
-                }
-            }]
+            documents = self._chunk(content, {
+                "filename": filename,
+                "type": "text",
+                "size": len(content)
+            })
+            return self._number_chunks(documents) if documents else [{"text": "Text file is empty", "metadata": {"filename": filename, "type": "error"}}]
         except Exception as e:
             return [{"text": f"Error processing text file: {str(e)}", "metadata": {"filename": filename, "type": "error"}}]
     
+    def _extract_pdf_text(self, file_path: str, total_pages: int) -> List[Tuple[int, str, bool]]:
+        """Extract every page's text, splitting large PDFs into page ranges across processes"""
+        if total_pages < PDF_PARALLEL_MIN_PAGES or self.pdf_processes <= 1:
+            return extract_pdf_pages(file_path, 0, total_pages)
+        
+        pool = self._get_pdf_pool()
+        try:
+            futures = [
+                pool.submit(extract_pdf_pages, file_path, start, min(start + PDF_PAGES_PER_TASK, total_pages))
+                for start in range(0, total_pages, PDF_PAGES_PER_TASK)
+            ]
+            return [page for future in futures for page in future.result()]
+        except BrokenProcessPool:
+            # A worker died (e.g. out of memory on a large scan); replace the pool and
+            # extract this file in-process
+            print(f"PDF worker pool broke while extracting {file_path}, extracting serially")
+            self._discard_pdf_pool(pool)
+            return extract_pdf_pages(file_path, 0, total_pages)
+    
     def _process_pdf(self, file_path: str, filename: str) -> List[Dict]:
         """Process PDF file"""
         try:
-            documents = []
             with open(file_path, 'rb') as f:
-                pdf_reader = PyPDF2.PdfReader(f)
-                
-                for page_num in range(len(pdf_reader.pages)):
-                    page = pdf_reader.pages[page_num]
-                    text = page.extract_text()
-                    
-                    if text.strip():
-                        documents.append({
-                            "text": text,
-                            "metadata": {
-                                "filename": filename,
-                                "type": "pdf",
-                                "page": page_num + 1,
-                                "total_pages": len(pdf_reader.pages)
-                            }
-                        })
+                total_pages = len(PyPDF2.PdfReader(f).pages)
             
-            return documents if documents else [{"text": "PDF contains no extractable text", "metadata": {"filename": filename, "type": "error"}}]
+            documents = []
+            for page_num, text, ocr_used in self._extract_pdf_text(file_path, total_pages):
+                if text.strip():
+                    metadata = {
+                        "filename": filename,
+                        "type": "pdf",
+                        "page": page_num + 1,
+                        "total_pages": total_pages
+                    }
+                    if ocr_used:
+                        metadata["ocr"] = True
+                    # Offsets are relative to the page text
+                    documents.extend(self._chunk(text, metadata))
+            
+            return self._number_chunks(documents) if documents else [{"text": "PDF contains no extractable text", "metadata": {"filename": filename, "type": "error"}}]
         except Exception as e:
             return [{"text": f"Error processing PDF: {str(e)}", "metadata": {"filename": filename, "type": "error"}}]
     
@@ -86,14 +156,19 @@ class FileProcessor:
             paragraphs = [p.text for p in doc.paragraphs if p.text.strip()]
             content = '\n\n'.join(paragraphs)
             
-            return [{
-                "text": content,
-                "metadata": {
-                    "filename": filename,
-                    "type": "docx",
-                    "paragraphs": len(paragraphs)
-                }
-            }]
+            # One section per docx paragraph, located within the joined content
+            sections = []
+            offset = 0
+            for paragraph in paragraphs:
+                sections.append((offset, offset + len(paragraph), None))
+                offset += len(paragraph) + 2
+            
+            documents = self._chunk(content, {
+                "filename": filename,
+                "type": "docx",
+                "paragraphs": len(paragraphs)
+            }, sections)
+            return self._number_chunks(documents) if documents else [{"text": "DOCX contains no text", "metadata": {"filename": filename, "type": "error"}}]
         except Exception as e:
             return [{"text": f"Error processing DOCX: {str(e)}", "metadata": {"filename": filename, "type": "error"}}]
     
@@ -103,52 +178,62 @@ class FileProcessor:
             with open(file_path, 'r', encoding='utf-8') as f:
                 content = f.read()
             
-            return [{
-                "text": content,
-                "metadata": {
-                    "filename": filename,
-                    "type": "markdown",
-                    "size": len(content)
-                }
-            }]
+            documents = self._chunk(content, {
+                "filename": filename,
+                "type": "markdown",
+                "size": len(content)
+            }, markdown_sections(content))
+            return self._number_chunks(documents) if documents else [{"text": "Markdown file is empty", "metadata": {"filename": filename, "type": "error"}}]
         except Exception as e:
             return [{"text": f"Error processing Markdown: {str(e)}", "metadata": {"filename": filename, "type": "error"}}]
     
     def _process_image(self, file_path: str, filename: str) -> List[Dict]:
-        """Process image file - extract text via OCR and generate description"""
+        """Process image file - extract text via OCR and generate description concurrently"""
         try:
             documents = []
             
-            # OCR to extract text
+            # Decode and normalize once; both steps get a downscaled copy
             try:
-                image = Image.open(file_path)
-                ocr_text = pytesseract.image_to_string(image)
+                image = load_image(file_path)
+            except Exception as decode_error:
+                # Neither OCR nor the vision model can use an image Pillow can't read
+                print(f"Image decoding failed for {filename}: {decode_error}")
+                image = None
+            
+            if image is not None:
+                # Generate visual description using GPT-4 Vision while OCR runs locally
+                description_future = self._description_pool.submit(
+                    self.llm_service.generate_image_description, file_path, vision_jpeg(image)
+                )
+                
+                # OCR to extract text
+                try:
+                    ocr_text = pytesseract.image_to_string(ocr_image(image))
+                    
+                    if ocr_text.strip():
+                        documents.append({
+                            "text": f"OCR Text from {filename}:\n{ocr_text}",
+                            "metadata": {
+                                "filename": filename,
+                                "type": "image_ocr",
+                                "image_type": "ocr"
+                            }
+                        })
+                except Exception as ocr_error:
+                    print(f"OCR failed for {filename}: {ocr_error}")
                 
-                if ocr_text.strip():
+                try:
+                    description = description_future.result()
                     documents.append({
-                        "text": f"OCR Text from {filename}:\n{ocr_text}",
+                        "text": f"Visual Description of {filename}:\n{description}",
                         "metadata": {
                             "filename": filename,
-                            "type": "image_ocr",
-                            "image_type": "ocr"
+                            "type": "image_description",
+                            "image_type": "description"
                         }
                     })
-            except Exception as ocr_error:
-                print(f"OCR failed for {filename}: {ocr_error}")
-            
-            # Generate visual description using GPT-4 Vision
-            try:
-                description = self.llm_service.generate_image_description(file_path)
-                documents.append({
-                    "text": f"Visual Description of {filename}:\n{description}",
-                    "metadata": {
-                        "filename": filename,
-                        "type": "image_description",
-                        "image_type": "description"
-                    }
-                })
-            except Exception as desc_error:
-                print(f"Description generation failed for {filename}: {desc_error}")
+                except Exception as desc_error:
+                    print(f"Description generation failed for {filename}: {desc_error}")
             
             return documents if documents else [{
                 "text": f"Image processed: {filename} (no text extracted)",
@@ -156,4 +241,3 @@ class FileProcessor:
             }]
         except Exception as e:
             return [{"text": f"Error processing image: {str(e)}", "metadata": {"filename": filename, "type": "error"}}]
-
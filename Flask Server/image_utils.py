@@ -0,0 +1,42 @@
+import io
+import os
+from PIL import Image, ImageOps
+
+# Longest side sent to the vision model; gpt-4o scales larger images down to fit 2048px anyway
+VISION_MAX_IMAGE_SIDE = int(os.getenv('VISION_MAX_IMAGE_SIDE', '2048'))
+VISION_JPEG_QUALITY = int(os.getenv('VISION_JPEG_QUALITY', '85'))
+# Longest side handed to Tesseract; kept larger since small text needs the resolution
+OCR_MAX_IMAGE_SIDE = int(os.getenv('OCR_MAX_IMAGE_SIDE', '4000'))
+
+def load_image(path: str) -> Image.Image:
+    """Open an image with EXIF orientation applied and convert it to RGB"""
+    with Image.open(path) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode in ('RGBA', 'LA', 'P'):
+            # Flatten transparency onto white so text stays readable
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel('A'))
+            return background
+        return image.convert('RGB')
+
+def fit_image(image: Image.Image, max_side: int) -> Image.Image:
+    """Downscale so the longest side is at most max_side (never upscales)"""
+    if max(image.size) <= max_side:
+        return image
+    resized = image.copy()
+    resized.thumbnail((max_side, max_side), Image.LANCZOS)
+    return resized
+
+def ocr_image(image: Image.Image) -> Image.Image:
+    """Grayscale, size-capped copy of an image for Tesseract"""
+    return fit_image(image, OCR_MAX_IMAGE_SIDE).convert('L')
+
+def vision_jpeg(image: Image.Image) -> bytes:
+    """Downscaled JPEG bytes of an image for the vision API"""
+    buffer = io.BytesIO()
+    fit_image(image, VISION_MAX_IMAGE_SIDE).save(buffer, format='JPEG', quality=VISION_JPEG_QUALITY, optimize=True)
+    return buffer.getvalue()
+
+def vision_jpeg_from_path(path: str) -> bytes:
+    return vision_jpeg(load_image(path))
@@ -0,0 +1,184 @@
+from dotenv import load_dotenv
+
+# Load .env before database reads its settings (matters when run as a standalone process)
+load_dotenv()
+
+from database import get_db, remove_db, init_db, Dataset, UploadedFile, IngestionJob, IngestionJobFile
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from datetime import datetime, timedelta, UTC
+from sqlalchemy import or_, and_
+import os
+import socket
+import threading
+import time
+import uuid
+
+class IngestionWorker:
+    """
+    Processes queued ingestion jobs in the background
+    A job is claimed with a lease that is renewed while its files are processed. If the
+    worker dies (e.g. the server restarts mid-ZIP) the lease goes stale and the job is
+    picked up again, resuming after the last committed file.
+    """
+    def __init__(self, file_processor, vector_store, max_workers: int = None, poll_interval: float = None, lease_seconds: float = None):
+        self.file_processor = file_processor
+        self.vector_store = vector_store
+        # Number of files processed and embedded concurrently within a job
+        self.max_workers = max_workers or int(os.getenv('INGEST_WORKERS', '4'))
+        self.poll_interval = poll_interval or float(os.getenv('INGEST_POLL_INTERVAL', '1.0'))
+        self.lease_seconds = lease_seconds or float(os.getenv('INGEST_LEASE_SECONDS', '120'))
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._thread = None
+    
+    def start(self):
+        """Run the worker loop in a daemon thread"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run_forever, name='ingestion-worker', daemon=True)
+            self._thread.start()
+    
+    def run_forever(self):
+        print(f"Ingestion worker {self.worker_id} started")
+        while True:
+            try:
+                job_id = self.claim_next_job()
+                if job_id is None:
+                    time.sleep(self.poll_interval)
+                else:
+                    self.run_job(job_id)
+            except Exception as e:
+                print(f"Ingestion worker error: {e}")
+                import traceback
+                traceback.print_exc()
+                time.sleep(self.poll_interval)
+            finally:
+                remove_db()
+    
+    def claim_next_job(self):
+        """Claim the oldest queued job, or a running job whose lease expired; returns its id"""
+        db = get_db()
+        stale_before = datetime.now(UTC) - timedelta(seconds=self.lease_seconds)
+        candidate = db.query(IngestionJob).filter(or_(
+            IngestionJob.status == 'queued',
+            and_(IngestionJob.status == 'running', IngestionJob.heartbeat_at < stale_before)
+        )).order_by(IngestionJob.id).first()
+        
+        if not candidate:
+            db.rollback()
+            return None
+        
+        # Conditional update so only one worker wins the claim
+        heartbeat_filter = IngestionJob.heartbeat_at.is_(None) if candidate.heartbeat_at is None else IngestionJob.heartbeat_at == candidate.heartbeat_at
+        claimed = db.query(IngestionJob).filter(
+            IngestionJob.id == candidate.id,
+            IngestionJob.status == candidate.status,
+            heartbeat_filter
+        ).update({
+            'status': 'running',
+            'claimed_by': self.worker_id,
+            'heartbeat_at': datetime.now(UTC)
+        }, synchronize_session=False)
+        db.commit()
+        
+        if not claimed:
+            return None
+        if candidate.processed_count:
+            print(f"Resuming ingestion job {candidate.id} after {candidate.processed_count} file(s)")
+        return candidate.id
+    
+    def ingest_file(self, collection_name: str, file_path: str, filename: str, file_key: str):
+        """Extract, chunk and embed one stored file; returns its documents"""
+        documents = self.file_processor.process_file(file_path, filename)
+        self.vector_store.add_documents(collection_name, documents, file_key=file_key)
+        return documents
+    
+    def run_job(self, job_id: int):
+        """Process a claimed job's remaining files, committing after each one"""
+        db = get_db()
+        job = db.get(IngestionJob, job_id)
+        dataset = db.get(Dataset, job.dataset_id)
+        
+        if not dataset:
+            job.status = 'failed'
+            job.errors = (job.errors or []) + [{'filename': None, 'error': 'Dataset not found'}]
+            job.finished_at = datetime.now(UTC)
+            db.commit()
+            return
+        
+        pending = db.query(IngestionJobFile).filter_by(job_id=job.id, status='pending').order_by(IngestionJobFile.position).all()
+        print(f"Ingestion job {job.id}: {len(pending)} file(s) to process")
+        
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            futures = [
+                executor.submit(self.ingest_file, dataset.collection_name, job_file.file_path, job_file.filename, job_file.stored_filename)
+                for job_file in pending
+            ]
+            
+            # Results are recorded in upload order so progress stays ordered
+            for job_file, future in zip(pending, futures):
+                try:
+                    documents = self._wait(db, job, future)
+                    file_size = os.path.getsize(job_file.file_path)
+                    
+                    uploaded_file = UploadedFile(
+                        dataset_id=dataset.id,
+                        original_filename=job_file.filename,
+                        stored_filename=job_file.stored_filename,
+                        file_path=job_file.file_path,
+                        file_type=os.path.splitext(job_file.filename)[1],
+                        file_size=file_size,
+                        chunks_count=len(documents)
+                    )
+                    db.add(uploaded_file)
+                    db.flush()  # Flush to get the ID
+                    
+                    job_file.status = 'completed'
+                    job_file.uploaded_file_id = uploaded_file.id
+                    job_file.chunks_count = len(documents)
+                    job_file.file_size = file_size
+                    dataset.file_count += 1
+                    dataset.version = (dataset.version or 0) + 1
+                    print(f"Successfully added file: {job_file.filename} (ID: {uploaded_file.id})")
+                except Exception as e:
+                    db.rollback()
+                    job_file.status = 'failed'
+                    job_file.error = str(e)
+                    print(f"Error processing file {job_file.filename}: {e}")
+                    # Drop any chunks written before the failure
+                    try:
+                        self.vector_store.delete_file_documents(dataset.collection_name, file_key=job_file.stored_filename)
+                    except Exception as cleanup_error:
+                        print(f"Error removing vectors for {job_file.filename}: {cleanup_error}")
+                
+                # The file row, its job entry and the progress counter commit together
+                job.processed_count = (job.processed_count or 0) + 1
+                job.heartbeat_at = datetime.now(UTC)
+                db.commit()
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+        
+        job.status = 'completed'
+        job.finished_at = datetime.now(UTC)
+        db.commit()
+        print(f"Ingestion job {job.id} completed")
+    
+    def _wait(self, db, job, future):
+        """Wait for a file's result, renewing the job lease while it runs"""
+        while True:
+            try:
+                return future.result(timeout=self.lease_seconds / 3)
+            except TimeoutError:
+                job.heartbeat_at = datetime.now(UTC)
+                db.commit()
+
+if __name__ == '__main__':
+    # Standalone worker process: python ingestion_worker.py
+    from file_processor import FileProcessor
+    from vector_store import VectorStore, CHROMA_HOST
+    
+    # The server would never see vectors written to a second embedded Chroma store
+    if not CHROMA_HOST:
+        raise SystemExit("A standalone ingestion worker needs a Chroma server: set CHROMA_HOST (and CHROMA_PORT) for both the worker and the app")
+    
+    init_db()
+    IngestionWorker(FileProcessor(), VectorStore()).run_forever()
@@ -0,0 +1,142 @@
+import os
+import re
+import threading
+import numpy as np
+from typing import Dict, Tuple
+
+# Chart/visualization phrases that force the 'generate_chart' intent
+CHART_KEYWORDS = [
+    'chart', 'graph', 'plot', 'visualize', 'visualization', 'show me the progression',
+    'show me a chart', 'show me a graph', 'trend line', 'bar chart', 'line graph',
+    'pie chart', 'scatter plot', 'histogram'
+]
+
+# Nouns that unambiguously mean an image; "figures" or "scan" are often data or verbs, so
+# they only send a message on to the later tiers
+GENERATE_NOUNS = r'(image|images|picture|pictures|pic|pics|photo|photos|illustration|drawing|painting|artwork|logo|portrait|wallpaper|visual)'
+FIND_NOUNS = r'(image|images|picture|pictures|pic|pics|photo|photos|photograph|photographs|diagram|diagrams|screenshot|screenshots)'
+
+# Up to two words between the verb and its object noun ("a watercolor", "the team"); a
+# preposition there means the noun isn't the object ("a summary of the images")
+_OBJECT_PREFIX = r'\s+((me|us)\s+)?((a|an|the|our|my|this|that|some)\s+)?((?!(of|for|with|from|about|in|on|to|and|or)\b)\w+\s+){0,2}'
+
+# Unambiguous phrasings, checked in order: an image verb whose direct object is an image noun
+INTENT_RULES = [
+    ('generate_image', re.compile(r'\b(create|generate|make|draw|paint|render)' + _OBJECT_PREFIX + GENERATE_NOUNS + r'\b')),
+    ('find_image', re.compile(r'\b(find|show|display|retrieve|fetch|pull up|look up|locate|open)' + _OBJECT_PREFIX + FIND_NOUNS + r'\b')),
+    ('find_image', re.compile(r'\b(where is|where are|which)' + _OBJECT_PREFIX + FIND_NOUNS + r'\b')),
+    ('find_image', re.compile(r'\bwhat\s+' + FIND_NOUNS + r'\s+(do|did|are|were)\b')),
+]
+
+# Asking for text about images ("a table of the photos"); a rule match alongside one of
+# these is left to the later tiers
+TEXT_REQUEST_WORDS = re.compile(
+    r'\b(summary|summarize|summarise|list|table|count|how many|number of|explain|describe|analy[sz]e|compare|report|conclusions?)\b'
+)
+
+# Words that make a message worth a closer look; without any of them it is plain text
+VISUAL_VOCABULARY = re.compile(
+    r'\b(' + GENERATE_NOUNS[1:-1] + '|' + FIND_NOUNS[1:-1] + r'|figure|figures|scan|scans|draw|paint|sketch|render|illustrate|visuali[sz]e|show me|look like)\b'
+)
+
+# Prototype messages for the similarity tier
+INTENT_EXAMPLES = {
+    'text': [
+        'explain this to me', 'tell me about the contract', 'what is our refund policy',
+        'summarize the report', 'how does this work', 'describe what the image shows',
+        'what does the picture in the report say about revenue'
+    ],
+    'find_image': [
+        'show me the image of the product', 'find the diagram in our files', 'what images do we have',
+        'do we have a photo of the office', 'pull up the screenshot from the onboarding doc',
+        'is there a picture of the team'
+    ],
+    'generate_image': [
+        'create an image of a sunset', 'generate a picture of a cat', 'draw me a dragon',
+        'make a visual of a city at night', 'design a logo for our brand', 'paint a mountain landscape'
+    ],
+}
+
+def _ngram_vector(text: str, dims: int) -> np.ndarray:
+    """Hashed character-trigram vector (L2-normalized); cheap, local and deterministic"""
+    vector = np.zeros(dims, dtype=np.float32)
+    padded = f'  {text}  '
+    for i in range(len(padded) - 2):
+        # Python's str hash is salted per process, so use a stable polynomial hash
+        h = 0
+        for ch in padded[i:i + 3]:
+            h = (h * 131 + ord(ch)) & 0xFFFFFFFF
+        vector[h % dims] += 1.0
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+class IntentClassifier:
+    """
+    Local first tiers of intent classification
+    1. Rules: chart keywords, unambiguous image phrasings, and messages with no visual
+       vocabulary at all (plain text).
+    2. Similarity: hashed character-trigram similarity to example messages per intent.
+    Messages neither tier is confident about return None and are escalated to an LLM.
+    """
+    def __init__(self, similarity_threshold: float = None, similarity_margin: float = None, dims: int = 2048):
+        self.similarity_threshold = similarity_threshold if similarity_threshold is not None else float(os.getenv('INTENT_SIMILARITY_THRESHOLD', '0.6'))
+        self.similarity_margin = similarity_margin if similarity_margin is not None else float(os.getenv('INTENT_SIMILARITY_MARGIN', '0.1'))
+        self.dims = dims
+        self.labels = []
+        vectors = []
+        for intent, examples in INTENT_EXAMPLES.items():
+            for example in examples:
+                self.labels.append(intent)
+                vectors.append(_ngram_vector(example, dims))
+        self.example_vectors = np.vstack(vectors)
+        self.counts = {'rules': 0, 'similarity': 0, 'llm': 0}
+        self._lock = threading.Lock()
+    
+    def classify(self, user_message: str) -> Tuple[str, str]:
+        """Return (intent, tier), or (None, None) when the message needs the LLM"""
+        message = re.sub(r'\s+', ' ', user_message.lower()).strip()
+        
+        intent = self._rules(message)
+        if intent:
+            self._count('rules')
+            return intent, 'rules'
+        
+        intent = self._similarity(message)
+        if intent:
+            self._count('similarity')
+            return intent, 'similarity'
+        
+        return None, None
+    
+    def record_escalation(self):
+        self._count('llm')
+    
+    def _rules(self, message: str) -> str:
+        if any(keyword in message for keyword in CHART_KEYWORDS):
+            return 'generate_chart'
+        for intent, pattern in INTENT_RULES:
+            if pattern.search(message):
+                return None if TEXT_REQUEST_WORDS.search(message) else intent
+        if not VISUAL_VOCABULARY.search(message):
+            return 'text'
+        return None
+    
+    def _similarity(self, message: str) -> str:
+        scores = self.example_vectors @ _ngram_vector(message, self.dims)
+        best = {}
+        for label, score in zip(self.labels, scores):
+            best[label] = max(best.get(label, 0.0), float(score))
+        ranked = sorted(best.items(), key=lambda item: item[1], reverse=True)
+        (top_intent, top_score), (_, runner_up) = ranked[0], ranked[1]
+        if top_score >= self.similarity_threshold and top_score - runner_up >= self.similarity_margin:
+            return top_intent
+        return None
+    
+    def _count(self, tier: str):
+        with self._lock:
+            self.counts[tier] += 1
+    
+    def stats(self) -> Dict:
+        with self._lock:
+            total = sum(self.counts.values())
+            return dict(self.counts, local_rate=(total - self.counts['llm']) / total if total else 0.0)
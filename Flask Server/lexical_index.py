@@ -0,0 +1,122 @@
+import sqlite3
+import threading
+import json
+import os
+from typing import List, Dict
+
+class LexicalIndex:
+    """
+    Local BM25 keyword index over dataset chunks (SQLite FTS5)
+    Mirrors each Chroma collection so exact identifiers (invoice numbers, filenames, codes)
+    can be matched even when embeddings miss them. Rows are keyed by the Chroma vector id.
+    """
+    def __init__(self, path: str = None):
+        self.path = path or os.getenv('LEXICAL_INDEX_PATH', './lexical_index.db')
+        self._lock = threading.Lock()
+        
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        # Filenames are indexed too so a query naming a file finds its chunks
+        self._conn.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS chunks USING fts5(
+                text,
+                filename,
+                collection UNINDEXED,
+                vector_id UNINDEXED,
+                file_key UNINDEXED,
+                metadata UNINDEXED,
+                tokenize = 'unicode61 remove_diacritics 2'
+            )
+        ''')
+        self._conn.commit()
+    
+    @staticmethod
+    def match_expression(query_text: str) -> str:
+        """
+        Build an FTS5 query matching any query term
+        Each whitespace-separated term is quoted as a phrase, so "INV-2024-001" matches
+        its tokens in sequence and FTS5 operators in user text are treated literally.
+        """
+        terms = [term.replace('"', '""') for term in query_text.split()]
+        return ' OR '.join(f'"{term}"' for term in terms if term.strip('"'))
+    
+    def upsert(self, collection: str, ids: List[str], texts: List[str], metadatas: List[Dict]):
+        """Index chunks, replacing any rows with the same vector ids"""
+        with self._lock:
+            self._delete_ids(collection, ids)
+            self._conn.executemany(
+                'INSERT INTO chunks (text, filename, collection, vector_id, file_key, metadata) VALUES (?, ?, ?, ?, ?, ?)',
+                [
+                    (text, metadata.get('filename', ''), collection, vector_id, metadata.get('file_key'), json.dumps(metadata))
+                    for vector_id, text, metadata in zip(ids, texts, metadatas)
+                ]
+            )
+            self._conn.commit()
+    
+    def update_metadata(self, collection: str, ids: List[str], metadatas: List[Dict]):
+        with self._lock:
+            self._conn.executemany(
+                'UPDATE chunks SET metadata = ?, filename = ? WHERE collection = ? AND vector_id = ?',
+                [
+                    (json.dumps(metadata), metadata.get('filename', ''), collection, vector_id)
+                    for vector_id, metadata in zip(ids, metadatas)
+                ]
+            )
+            self._conn.commit()
+    
+    def delete(self, collection: str, ids: List[str] = None, file_key: str = None, filename: str = None):
+        """Remove chunks by vector id, file_key or filename"""
+        with self._lock:
+            if ids:
+                self._delete_ids(collection, ids)
+            if file_key:
+                self._conn.execute('DELETE FROM chunks WHERE collection = ? AND file_key = ?', (collection, file_key))
+            if filename:
+                self._conn.execute('DELETE FROM chunks WHERE collection = ? AND filename = ?', (collection, filename))
+            self._conn.commit()
+    
+    def delete_collection(self, collection: str):
+        with self._lock:
+            self._conn.execute('DELETE FROM chunks WHERE collection = ?', (collection,))
+            self._conn.commit()
+    
+    def count(self, collection: str) -> int:
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM chunks WHERE collection = ?', (collection,)).fetchone()[0]
+    
+    def search(self, collection: str, query_text: str, n_results: int = 5) -> List[Dict]:
+        """
+        BM25-ranked keyword search within one collection
+        Returns: [{"id", "text", "metadata", "bm25"}], best match first
+        """
+        expression = self.match_expression(query_text)
+        if not expression:
+            return []
+        
+        with self._lock:
+            rows = self._conn.execute(
+                '''
+                SELECT vector_id, text, metadata, bm25(chunks) AS score
+                FROM chunks
+                WHERE chunks MATCH ? AND collection = ?
+                ORDER BY score
+                LIMIT ?
+                ''',
+                (expression, collection, n_results)
+            ).fetchall()
+        
+        return [
+            {'id': vector_id, 'text': text, 'metadata': json.loads(metadata), 'bm25': score}
+            for vector_id, text, metadata, score in rows
+        ]
+    
+    def _delete_ids(self, collection: str, ids: List[str]):
+        # Stay well under SQLite's bound-parameter limit
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            placeholders = ','.join('?' * len(chunk))
+            self._conn.execute(
+                f'DELETE FROM chunks WHERE collection = ? AND vector_id IN ({placeholders})',
+                [collection] + chunk
+            )
@@ -1,24 +1,22 @@
-from openai import OpenAI
-from anthropic import Anthropic
-from groq import Groq
+from openai import OpenAI, AsyncOpenAI
+from anthropic import Anthropic, AsyncAnthropic
+from groq import Groq, AsyncGroq
+import asyncio
+import threading
+import httpx
 import os
 import base64
+from intent_classifier import IntentClassifier, CHART_KEYWORDS
+from image_utils import vision_jpeg_from_path
 
-class LLMService:
-    def __init__(self):
-        self.openai_client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
-        self.anthropic_client = Anthropic(api_key=os.getenv('ANTHROPIC_API_KEY'))
-        self.groq_client = Groq(api_key=os.getenv('GROQ_API_KEY'))
-        # Separate client for image generation
-        self.image_gen_client = OpenAI(api_key=os.getenv('OPENAI_IMAGE_GEN_KEY'))
-    
-    def classify_user_intent(self, user_message: str) -> str:
-        """
-        Use GPT-5 to classify user intent
-        Returns: 'text', 'find_image', 'generate_image', or 'generate_chart'
-        """
-        try:
-            classification_prompt = f"""You are an intent classifier. Analyze the user's message and determine their intent.
+# LLM used only for messages the local intent classifier can't decide
+INTENT_PROVIDER = os.getenv('INTENT_PROVIDER', 'openai')
+INTENT_MODEL = os.getenv('INTENT_MODEL', 'gpt-4o-mini')
+VALID_INTENTS = ['text', 'find_image', 'generate_image', 'generate_chart']
+
+def _intent_messages(user_message: str) -> list:
+    """Build the intent classification prompt"""
+    classification_prompt = f"""You are an intent classifier. Analyze the user's message and determine their intent.
 
 User message: "{user_message}"
 
@@ -32,38 +30,196 @@ IMPORTANT: If the user wants to visualize numerical data, trends, or create char
 
 Respond with ONLY the classification word: text, find_image, generate_chart, or generate_image"""
 
-            response = self.openai_client.chat.completions.create(
-                model="gpt-5-2025-08-07",
-                messages=[
-                    {"role": "system", "content": "You are a precise intent classifier. Respond with only one word: text, find_image, generate_chart, or generate_image."},
-                    {"role": "user", "content": classification_prompt}
-                ]
-            )
-            
-            intent = response.choices[0].message.content.strip().lower()
-            
-            # Additional validation for chart/visualization requests
-            chart_keywords = [
-                'chart', 'graph', 'plot', 'visualize', 'visualization', 'show me the progression',
-                'show me a chart', 'show me a graph', 'trend line', 'bar chart', 'line graph',
-                'pie chart', 'scatter plot', 'histogram'
+    return [
+        {"role": "system", "content": "You are a precise intent classifier. Respond with only one word: text, find_image, generate_chart, or generate_image."},
+        {"role": "user", "content": classification_prompt}
+    ]
+
+def _resolve_intent(raw_intent: str, user_message: str) -> str:
+    """Apply keyword overrides and validation to a classifier answer"""
+    intent = raw_intent.strip().lower()
+    
+    # If the message contains chart keywords, force it to be 'generate_chart'
+    if any(keyword in user_message.lower() for keyword in CHART_KEYWORDS):
+        return 'generate_chart'
+    
+    # Default to text if unclear
+    return intent if intent in VALID_INTENTS else 'text'
+
+# Mark messages flagged "cache": True as Anthropic prompt-cache breakpoints
+PROMPT_CACHING = os.getenv('PROMPT_CACHING', 'true').lower() in ('1', 'true', 'yes')
+
+def _plain_messages(messages: list) -> list:
+    """Drop the provider-neutral "cache" flag for APIs that cache prefixes automatically"""
+    return [{'role': msg['role'], 'content': msg['content']} for msg in messages]
+
+def _openai_params(model: str, messages: list, temperature: float) -> dict:
+    # GPT-5 models don't support custom temperature values
+    params = {
+        "model": model,
+        "messages": _plain_messages(messages)
+    }
+    
+    # Only add temperature for models that support it
+    if not model.startswith('gpt-5'):
+        params["temperature"] = temperature
+    return params
+
+def _anthropic_block(msg: dict) -> dict:
+    block = {'type': 'text', 'text': msg['content']}
+    if PROMPT_CACHING and msg.get('cache'):
+        block['cache_control'] = {'type': 'ephemeral'}
+    return block
+
+def _anthropic_params(model: str, messages: list, temperature: float) -> dict:
+    # Convert messages format for Anthropic
+    system_messages = []
+    claude_messages = []
+    
+    for msg in messages:
+        if msg['role'] == 'system':
+            system_messages.append(msg)
+        elif claude_messages and claude_messages[-1]['role'] == msg['role']:
+            # Consecutive same-role messages become content blocks of one message
+            previous = claude_messages[-1]
+            if isinstance(previous['content'], str):
+                previous['content'] = [{'type': 'text', 'text': previous['content']}]
+            previous['content'].append(_anthropic_block(msg))
+        elif PROMPT_CACHING and msg.get('cache'):
+            claude_messages.append({
+                'role': msg['role'],
+                'content': [_anthropic_block(msg)]
+            })
+        else:
+            claude_messages.append({
+                'role': msg['role'],
+                'content': msg['content']
+            })
+    
+    if any(PROMPT_CACHING and msg.get('cache') for msg in system_messages):
+        system = [_anthropic_block(msg) for msg in system_messages]
+    else:
+        system = "\n\n".join(msg['content'] for msg in system_messages)
+    
+    return {
+        "model": model,
+        "max_tokens": 4096,
+        "temperature": temperature,
+        "system": system if system else None,
+        "messages": claude_messages
+    }
+
+def _chat_completion_deltas(stream, usage_callback=None):
+    """Yield text deltas from an OpenAI-compatible chat completion stream"""
+    for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+        if usage_callback and getattr(chunk, 'usage', None):
+            usage_callback(chunk.usage)
+
+def _image_description_messages(image_data: str) -> list:
+    return [
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "text",
+                    "text": "Describe this image in detail. Include all visible elements, text, colors, composition, and context."
+                },
+                {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": f"data:image/jpeg;base64,{image_data}"
+                    }
+                }
             ]
-            
-            # If the message contains chart keywords, force it to be 'generate_chart'
-            if any(keyword in user_message.lower() for keyword in chart_keywords):
-                return 'generate_chart'
-            
-            # Validate response
-            if intent in ['text', 'find_image', 'generate_image', 'generate_chart']:
-                return intent
-            else:
-                # Default to text if unclear
-                return 'text'
-                
-        except Exception as e:
-            print(f"Error classifying intent: {e}")
-            # Default to text on error
-            return 'text'
+        }
+    ]
+
+def _image_result(response, prompt: str) -> dict:
+    """Extract the generated image from an Image API response"""
+    if response.data and len(response.data) > 0:
+        image_data = response.data[0]
+        # Get revised prompt, fallback to original if not available or empty
+        revised = getattr(image_data, 'revised_prompt', None)
+        final_prompt = revised if (revised and revised.strip()) else prompt
+        return {
+            'image_base64': image_data.b64_json,
+            'revised_prompt': final_prompt,
+            'format': 'png'
+        }
+    else:
+        raise Exception("No image was generated")
+
+def _read_file(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
+
+def _provider_http_client(provider: str) -> httpx.Client:
+    """
+    Keep-alive connection pool for one provider
+    Size comes from <PROVIDER>_MAX_CONNECTIONS (e.g. OPENAI_MAX_CONNECTIONS)
+    """
+    max_connections = int(os.getenv(f'{provider.upper()}_MAX_CONNECTIONS', '20'))
+    limits = httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=max_connections,
+        keepalive_expiry=float(os.getenv('LLM_HTTP_KEEPALIVE_EXPIRY', '60'))
+    )
+    timeout = httpx.Timeout(float(os.getenv('LLM_HTTP_TIMEOUT', '600')), connect=10.0)
+    return httpx.Client(limits=limits, timeout=timeout)
+
+class LLMService:
+    def __init__(self):
+        self.http_clients = {
+            'openai': _provider_http_client('openai'),
+            'anthropic': _provider_http_client('anthropic'),
+            'groq': _provider_http_client('groq')
+        }
+        self.openai_client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'), http_client=self.http_clients['openai'])
+        self.anthropic_client = Anthropic(api_key=os.getenv('ANTHROPIC_API_KEY'), http_client=self.http_clients['anthropic'])
+        self.groq_client = Groq(api_key=os.getenv('GROQ_API_KEY'), http_client=self.http_clients['groq'])
+        # Separate client for image generation (same host, so it shares the OpenAI pool)
+        self.image_gen_client = OpenAI(api_key=os.getenv('OPENAI_IMAGE_GEN_KEY'), http_client=self.http_clients['openai'])
+        # Prompt tokens billed at cached rates, per provider
+        self.prompt_cache = {
+            'openai': {'requests': 0, 'input_tokens': 0, 'cached_tokens': 0},
+            'anthropic': {'requests': 0, 'input_tokens': 0, 'cached_tokens': 0, 'cache_write_tokens': 0}
+        }
+        self._prompt_cache_lock = threading.Lock()
+        self.intent_classifier = IntentClassifier()
+    
+    def warm_up(self):
+        """
+        Open a pooled TLS connection to every provider so the first chat after boot
+        doesn't pay the handshake. The response status is irrelevant.
+        """
+        clients = {
+            'openai': self.openai_client,
+            'anthropic': self.anthropic_client,
+            'groq': self.groq_client
+        }
+        for provider, client in clients.items():
+            try:
+                self.http_clients[provider].head(str(client.base_url), timeout=5.0)
+            except Exception as e:
+                print(f"Warm-up failed for {provider}: {e}")
+    
+    def classify_user_intent(self, user_message: str) -> str:
+        """
+        Classify user intent, locally when possible
+        Rules and example similarity settle most messages without a network call; the rest
+        are escalated to INTENT_MODEL.
+        Returns: 'text', 'find_image', 'generate_image', or 'generate_chart'
+        """
+        intent, _ = self.intent_classifier.classify(user_message)
+        if intent:
+            return intent
+        
+        self.intent_classifier.record_escalation()
+        # call_llm returns "Error: ..." on failure, which resolves to 'text'
+        raw_intent = self.call_llm(INTENT_PROVIDER, INTENT_MODEL, _intent_messages(user_message), temperature=0)
+        return _resolve_intent(raw_intent, user_message)
     
     def call_llm(self, provider: str, model: str, messages: list, temperature: float = 0.7) -> str:
         """
@@ -86,75 +242,99 @@ Respond with ONLY the classification word: text, find_image, generate_chart, or
             return f"Error: {str(e)}"
     
     def _call_openai(self, model: str, messages: list, temperature: float) -> str:
-        # GPT-5 models don't support custom temperature values
-        params = {
-            "model": model,
-            "messages": messages
-        }
-        
-        # Only add temperature for models that support it
-        if not model.startswith('gpt-5'):
-            params["temperature"] = temperature
-        
-        response = self.openai_client.chat.completions.create(**params)
+        response = self.openai_client.chat.completions.create(**_openai_params(model, messages, temperature))
+        self._record_openai_usage(response.usage)
         return response.choices[0].message.content
     
     def _call_anthropic(self, model: str, messages: list, temperature: float) -> str:
-        # Convert messages format for Anthropic
-        system_message = ""
-        claude_messages = []
-        
-        for msg in messages:
-            if msg['role'] == 'system':
-                system_message = msg['content']
-            else:
-                claude_messages.append({
-                    'role': msg['role'],
-                    'content': msg['content']
-                })
-        
-        response = self.anthropic_client.messages.create(
-            model=model,
-            max_tokens=4096,
-            temperature=temperature,
-            system=system_message if system_message else None,
-            messages=claude_messages
-        )
+        response = self.anthropic_client.messages.create(**_anthropic_params(model, messages, temperature))
+        self._record_anthropic_usage(response.usage)
         return response.content[0].text
     
     def _call_groq(self, model: str, messages: list, temperature: float) -> str:
         response = self.groq_client.chat.completions.create(
             model=model,
-            messages=messages,
+            messages=_plain_messages(messages),
             temperature=temperature
         )
         return response.choices[0].message.content
     
-    def generate_image_description(self, image_path: str) -> str:
-        """Use GPT-4o (with vision) to generate image descriptions"""
+    def _record_openai_usage(self, usage):
+        if usage is None:
+            return
+        details = getattr(usage, 'prompt_tokens_details', None)
+        with self._prompt_cache_lock:
+            stats = self.prompt_cache['openai']
+            stats['requests'] += 1
+            stats['input_tokens'] += usage.prompt_tokens or 0
+            stats['cached_tokens'] += (getattr(details, 'cached_tokens', 0) or 0) if details else 0
+    
+    def _record_anthropic_usage(self, usage):
+        if usage is None:
+            return
+        cache_read = getattr(usage, 'cache_read_input_tokens', 0) or 0
+        cache_write = getattr(usage, 'cache_creation_input_tokens', 0) or 0
+        with self._prompt_cache_lock:
+            stats = self.prompt_cache['anthropic']
+            stats['requests'] += 1
+            # input_tokens excludes cached reads and writes
+            stats['input_tokens'] += (usage.input_tokens or 0) + cache_read + cache_write
+            stats['cached_tokens'] += cache_read
+            stats['cache_write_tokens'] += cache_write
+    
+    def prompt_cache_stats(self) -> dict:
+        """Prompt tokens sent and how many were served from provider prompt caches"""
+        with self._prompt_cache_lock:
+            return {
+                provider: dict(stats, hit_rate=stats['cached_tokens'] / stats['input_tokens'] if stats['input_tokens'] else 0.0)
+                for provider, stats in self.prompt_cache.items()
+            }
+    
+    def stream_llm(self, provider: str, model: str, messages: list, temperature: float = 0.7):
+        """
+        Streaming counterpart of call_llm: yields the response text piece by piece
+        Unlike call_llm, errors are raised: text may already have been yielded, and
+        appending an error to it would pass a broken answer off as a complete one
+        """
         try:
-            with open(image_path, 'rb') as image_file:
-                image_data = base64.b64encode(image_file.read()).decode('utf-8')
+            if provider == 'openai':
+                stream = self.openai_client.chat.completions.create(
+                    **_openai_params(model, messages, temperature),
+                    stream=True,
+                    stream_options={'include_usage': True}
+                )
+                yield from _chat_completion_deltas(stream, self._record_openai_usage)
+            elif provider == 'anthropic':
+                with self.anthropic_client.messages.stream(**_anthropic_params(model, messages, temperature)) as stream:
+                    yield from stream.text_stream
+                    self._record_anthropic_usage(stream.get_final_message().usage)
+            elif provider == 'groq':
+                stream = self.groq_client.chat.completions.create(
+                    model=model,
+                    messages=_plain_messages(messages),
+                    temperature=temperature,
+                    stream=True
+                )
+                yield from _chat_completion_deltas(stream)
+            else:
+                raise ValueError(f"Unknown provider: {provider}")
+        except Exception as e:
+            print(f"Error streaming from {provider}: {e}")
+            raise
+    
+    def generate_image_description(self, image_path: str, image_bytes: bytes = None) -> str:
+        """
+        Use GPT-4o (with vision) to generate image descriptions
+        The image is sent as a downscaled JPEG; pass image_bytes to reuse one already prepared.
+        """
+        try:
+            if image_bytes is None:
+                image_bytes = vision_jpeg_from_path(image_path)
+            image_data = base64.b64encode(image_bytes).decode('utf-8')
             
             response = self.openai_client.chat.completions.create(
                 model="gpt-4o",
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": "Describe this image in detail. Include all visible elements, text, colors, composition, and context."
-                            },
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,{image_data}"
-                                }
-                            }
-                        ]
-                    }
-                ],
+                messages=_image_description_messages(image_data),
                 max_tokens=500
             )
             return response.choices[0].message.content
@@ -176,8 +356,6 @@ Respond with ONLY the classification word: text, find_image, generate_chart, or
             dict with 'image_base64', 'revised_prompt', 'format'
         """
         try:
-            import base64
-            
             # Build the input for the API
             if reference_image_path:
                 # Editing mode: use gpt-image-1 edit endpoint with reference image
@@ -199,21 +377,144 @@ Respond with ONLY the classification word: text, find_image, generate_chart, or
                     quality=quality
                 )
             
-            # Extract the generated image
-            if response.data and len(response.data) > 0:
-                image_data = response.data[0]
-                # Get revised prompt, fallback to original if not available or empty
-                revised = getattr(image_data, 'revised_prompt', None)
-                final_prompt = revised if (revised and revised.strip()) else prompt
-                return {
-                    'image_base64': image_data.b64_json,
-                    'revised_prompt': final_prompt,
-                    'format': 'png'
-                }
-            else:
-                raise Exception("No image was generated")
+            return _image_result(response, prompt)
                 
         except Exception as e:
             print(f"Error generating image: {e}")
             raise e
 
+
+_llm_service = None
+_llm_service_lock = threading.Lock()
+
+def get_llm_service() -> LLMService:
+    """Return the process-wide LLMService, creating it on first use"""
+    global _llm_service
+    if _llm_service is None:
+        with _llm_service_lock:
+            if _llm_service is None:
+                _llm_service = LLMService()
+    return _llm_service
+
+def create_async_http_client() -> httpx.AsyncClient:
+    """
+    Build the keep-alive connection pool shared by all async provider clients
+    Pool sizes come from LLM_HTTP_MAX_CONNECTIONS / LLM_HTTP_MAX_KEEPALIVE
+    """
+    limits = httpx.Limits(
+        max_connections=int(os.getenv('LLM_HTTP_MAX_CONNECTIONS', '200')),
+        max_keepalive_connections=int(os.getenv('LLM_HTTP_MAX_KEEPALIVE', '50')),
+        keepalive_expiry=float(os.getenv('LLM_HTTP_KEEPALIVE_EXPIRY', '60'))
+    )
+    timeout = httpx.Timeout(float(os.getenv('LLM_HTTP_TIMEOUT', '600')), connect=10.0)
+    return httpx.AsyncClient(limits=limits, timeout=timeout)
+
+class AsyncLLMService:
+    """
+    Async counterpart of LLMService
+    All provider clients share one httpx connection pool, so many chorus calls can be
+    in flight on a single event loop without a thread per call. Create one instance per
+    event loop and close it with aclose() (or use it as an async context manager).
+    """
+    def __init__(self, http_client: httpx.AsyncClient = None):
+        self.http_client = http_client or create_async_http_client()
+        self.openai_client = AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'), http_client=self.http_client)
+        self.anthropic_client = AsyncAnthropic(api_key=os.getenv('ANTHROPIC_API_KEY'), http_client=self.http_client)
+        self.groq_client = AsyncGroq(api_key=os.getenv('GROQ_API_KEY'), http_client=self.http_client)
+        # Separate client for image generation
+        self.image_gen_client = AsyncOpenAI(api_key=os.getenv('OPENAI_IMAGE_GEN_KEY'), http_client=self.http_client)
+        self.intent_classifier = IntentClassifier()
+    
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+    
+    async def aclose(self):
+        """Close the shared connection pool"""
+        await self.http_client.aclose()
+    
+    async def classify_user_intent(self, user_message: str) -> str:
+        """
+        Classify user intent, locally when possible
+        Returns: 'text', 'find_image', 'generate_image', or 'generate_chart'
+        """
+        intent, _ = self.intent_classifier.classify(user_message)
+        if intent:
+            return intent
+        
+        self.intent_classifier.record_escalation()
+        raw_intent = await self.call_llm(INTENT_PROVIDER, INTENT_MODEL, _intent_messages(user_message), temperature=0)
+        return _resolve_intent(raw_intent, user_message)
+    
+    async def call_llm(self, provider: str, model: str, messages: list, temperature: float = 0.7) -> str:
+        """
+        Universal async LLM caller
+        provider: 'openai', 'anthropic', or 'groq'
+        model: model name
+        messages: list of message dicts
+        """
+        try:
+            if provider == 'openai':
+                response = await self.openai_client.chat.completions.create(**_openai_params(model, messages, temperature))
+                return response.choices[0].message.content
+            elif provider == 'anthropic':
+                response = await self.anthropic_client.messages.create(**_anthropic_params(model, messages, temperature))
+                return response.content[0].text
+            elif provider == 'groq':
+                response = await self.groq_client.chat.completions.create(
+                    model=model,
+                    messages=_plain_messages(messages),
+                    temperature=temperature
+                )
+                return response.choices[0].message.content
+            else:
+                raise ValueError(f"Unknown provider: {provider}")
+        except Exception as e:
+            print(f"Error calling {provider}: {e}")
+            return f"Error: {str(e)}"
+    
+    async def generate_image_description(self, image_path: str, image_bytes: bytes = None) -> str:
+        """Use GPT-4o (with vision) to generate image descriptions"""
+        try:
+            if image_bytes is None:
+                image_bytes = await asyncio.to_thread(vision_jpeg_from_path, image_path)
+            image_data = base64.b64encode(image_bytes).decode('utf-8')
+            
+            response = await self.openai_client.chat.completions.create(
+                model="gpt-4o",
+                messages=_image_description_messages(image_data),
+                max_tokens=500
+            )
+            return response.choices[0].message.content
+        except Exception as e:
+            print(f"Error generating image description: {e}")
+            return f"Image description unavailable: {str(e)}"
+    
+    async def generate_image(self, prompt: str, reference_image_path: str = None, quality: str = "high", size: str = "1024x1024") -> dict:
+        """
+        Generate an image using GPT Image (gpt-image-1) via Image API
+        Same arguments and return value as LLMService.generate_image
+        """
+        try:
+            if reference_image_path:
+                image_bytes = await asyncio.to_thread(_read_file, reference_image_path)
+                response = await self.image_gen_client.images.edit(
+                    model="gpt-image-1",
+                    image=(os.path.basename(reference_image_path), image_bytes),
+                    prompt=prompt
+                )
+            else:
+                response = await self.image_gen_client.images.generate(
+                    model="gpt-image-1",
+                    prompt=prompt,
+                    size=size,
+                    quality=quality
+                )
+            
+            return _image_result(response, prompt)
+                
+        except Exception as e:
+            print(f"Error generating image: {e}")
+            raise e
\ No newline at end of file
@@ -0,0 +1,79 @@
+import io
+import os
+import pytesseract
+import PyPDF2
+from PIL import Image
+from typing import List, Tuple
+
+# Imported by the PDF extraction worker processes, so keep it free of services
+
+try:
+    import fitz  # PyMuPDF, used to rasterize scanned PDF pages for OCR
+except ImportError:
+    fitz = None
+
+PDF_OCR_FALLBACK = os.getenv('PDF_OCR_FALLBACK', 'true').lower() in ('1', 'true', 'yes')
+PDF_OCR_DPI = int(os.getenv('PDF_OCR_DPI', '200'))
+
+def configure_tesseract():
+    """Set Tesseract path for Windows if not in PATH"""
+    if os.name == 'nt':  # Windows
+        tesseract_path = r'C:\Program Files\Tesseract-OCR\tesseract.exe'
+        if os.path.exists(tesseract_path):
+            pytesseract.pytesseract.tesseract_cmd = tesseract_path
+
+def ocr_pdf_page(page, page_num: int, document=None) -> str:
+    """
+    OCR a PDF page that has no text layer
+    The page is rasterized with PyMuPDF when available; otherwise the images embedded
+    in the page (usually the whole scan) are OCR'd instead.
+    """
+    if document is not None:
+        pixmap = document[page_num].get_pixmap(dpi=PDF_OCR_DPI)
+        image = Image.frombytes('RGB', (pixmap.width, pixmap.height), pixmap.samples)
+        return pytesseract.image_to_string(image)
+    
+    texts = []
+    for embedded in page.images:
+        # PyPDF2 only exposes the raw bytes; skip images Pillow can't decode (e.g. JBIG2)
+        try:
+            image = Image.open(io.BytesIO(embedded.data))
+            image.load()
+        except Exception as decode_error:
+            print(f"Skipping undecodable image {embedded.name} on page {page_num + 1}: {decode_error}")
+            continue
+        texts.append(pytesseract.image_to_string(image))
+    return '\n'.join(texts)
+
+def extract_pdf_pages(file_path: str, start: int, end: int, ocr_fallback: bool = PDF_OCR_FALLBACK) -> List[Tuple[int, str, bool]]:
+    """
+    Extract text from pages [start, end) of a PDF
+    Runs in worker processes for large PDFs, so it opens its own readers.
+    Returns: [(page_num, text, ocr_used)]
+    """
+    configure_tesseract()
+    pages = []
+    document = None
+    try:
+        with open(file_path, 'rb') as f:
+            pdf_reader = PyPDF2.PdfReader(f)
+            
+            for page_num in range(start, end):
+                page = pdf_reader.pages[page_num]
+                text = page.extract_text() or ''
+                ocr_used = False
+                
+                if not text.strip() and ocr_fallback:
+                    try:
+                        if document is None and fitz is not None:
+                            document = fitz.open(file_path)
+                        text = ocr_pdf_page(page, page_num, document)
+                        ocr_used = True
+                    except Exception as ocr_error:
+                        print(f"OCR failed for page {page_num + 1} of {file_path}: {ocr_error}")
+                
+                pages.append((page_num, text, ocr_used))
+    finally:
+        if document is not None:
+            document.close()
+    return pages
@@ -0,0 +1,120 @@
+import os
+import threading
+import numpy as np
+from typing import List, Dict
+from token_utils import count_tokens
+
+try:
+    from sentence_transformers import CrossEncoder
+except ImportError:
+    CrossEncoder = None
+
+RERANK_MODES = ['none', 'mmr', 'cross_encoder']
+
+class Reranker:
+    """
+    Rerank stage applied to over-fetched retrieval candidates
+    'mmr' picks relevant but mutually diverse chunks using their embeddings; 'cross_encoder'
+    scores (query, chunk) pairs with a local cross-encoder (falls back to MMR when
+    sentence-transformers isn't installed). Either way the result is trimmed to n_results
+    and, when one is set, to a token budget (prompt context is normally packed by
+    ContextBuilder instead).
+    """
+    def __init__(self, mode: str = None, mmr_lambda: float = None, max_tokens: int = None, cross_encoder_model: str = None):
+        self.mode = mode or os.getenv('RERANK_MODE', 'mmr')
+        # 1.0 ranks purely by relevance, lower values favour diversity
+        self.mmr_lambda = mmr_lambda if mmr_lambda is not None else float(os.getenv('RERANK_MMR_LAMBDA', '0.7'))
+        # Total tokens of chunks kept after reranking (0, the default, disables the budget)
+        self.max_tokens = max_tokens if max_tokens is not None else int(os.getenv('RERANK_MAX_TOKENS', '0'))
+        self.cross_encoder_model = cross_encoder_model or os.getenv('RERANK_CROSS_ENCODER_MODEL', 'cross-encoder/ms-marco-MiniLM-L-6-v2')
+        self._cross_encoder = None
+        self._cross_encoder_lock = threading.Lock()
+        
+        if self.mode == 'cross_encoder' and CrossEncoder is None:
+            print("sentence-transformers is not installed, reranking with MMR instead")
+            self.mode = 'mmr'
+    
+    @property
+    def enabled(self) -> bool:
+        return self.mode != 'none'
+    
+    @property
+    def needs_embeddings(self) -> bool:
+        return self.mode == 'mmr'
+    
+    def rerank(self, query_text: str, query_embedding: List[float], results: List[Dict], n_results: int, max_tokens: int = None) -> List[Dict]:
+        """
+        Reorder candidates and keep the best n_results, within max_tokens if given
+        (defaults to RERANK_MAX_TOKENS; 0 means no budget)
+        results need an "embedding" for MMR; returned in the new order without it.
+        """
+        if not self.enabled or not results:
+            return results[:n_results]
+        
+        if self.mode == 'cross_encoder':
+            ranked = self._cross_encode(query_text, results)
+        else:
+            ranked = self._mmr(query_embedding, results, n_results)
+        
+        for result in ranked:
+            result.pop('embedding', None)
+        return self._trim_to_budget(ranked[:n_results], self.max_tokens if max_tokens is None else max_tokens)
+    
+    def _mmr(self, query_embedding: List[float], results: List[Dict], n_results: int) -> List[Dict]:
+        """Maximal marginal relevance: lambda * sim(query, d) - (1 - lambda) * max sim(d, selected)"""
+        with_embeddings = [result for result in results if result.get('embedding') is not None]
+        if not with_embeddings:
+            return results
+        
+        vectors = np.asarray([result['embedding'] for result in with_embeddings], dtype=np.float32)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        query = np.asarray(query_embedding, dtype=np.float32)
+        query /= max(np.linalg.norm(query), 1e-12)
+        
+        relevance = vectors @ query
+        similarity = vectors @ vectors.T
+        redundancy = np.full(len(with_embeddings), -np.inf)
+        remaining = list(range(len(with_embeddings)))
+        selected = []
+        
+        while remaining and len(selected) < n_results:
+            if selected:
+                scores = self.mmr_lambda * relevance[remaining] - (1 - self.mmr_lambda) * redundancy[remaining]
+            else:
+                scores = relevance[remaining]
+            best = remaining.pop(int(np.argmax(scores)))
+            selected.append(best)
+            redundancy = np.maximum(redundancy, similarity[best])
+        
+        ranked = [with_embeddings[i] for i in selected] + [with_embeddings[i] for i in remaining]
+        # Candidates without a stored embedding keep their retrieval order at the end
+        return ranked + [result for result in results if result.get('embedding') is None]
+    
+    def _cross_encode(self, query_text: str, results: List[Dict]) -> List[Dict]:
+        scores = self._get_cross_encoder().predict([(query_text, result['text']) for result in results])
+        for result, score in zip(results, scores):
+            result['rerank_score'] = float(score)
+        return sorted(results, key=lambda result: result['rerank_score'], reverse=True)
+    
+    def _get_cross_encoder(self):
+        """Load the cross-encoder on first use (it downloads weights the first time)"""
+        if self._cross_encoder is None:
+            with self._cross_encoder_lock:
+                if self._cross_encoder is None:
+                    self._cross_encoder = CrossEncoder(self.cross_encoder_model)
+        return self._cross_encoder
+    
+    def _trim_to_budget(self, results: List[Dict], max_tokens: int) -> List[Dict]:
+        """Keep results in order until the token budget is spent (always keeps the first)"""
+        if not max_tokens:
+            return results
+        
+        kept = []
+        used = 0
+        for result in results:
+            tokens = count_tokens(result['text'])
+            if kept and used + tokens > max_tokens:
+                break
+            kept.append(result)
+            used += tokens
+        return kept
@@ -0,0 +1,103 @@
+from database import CachedResponse
+from datetime import datetime, timedelta, UTC
+from typing import Dict
+import hashlib
+import json
+import os
+import re
+import threading
+import unicodedata
+
+def normalize_query(query: str) -> str:
+    """Case-, whitespace- and trailing-punctuation-insensitive form of a question"""
+    query = unicodedata.normalize('NFKC', query).lower()
+    query = re.sub(r'\s+', ' ', query).strip()
+    return query.rstrip('?!. ')
+
+def config_hash(bot, chorus_model, n_results: int) -> str:
+    """Hash of everything besides the question and dataset that shapes a chorus answer"""
+    config = {
+        'instructions': bot.instructions,
+        'responder_llms': chorus_model.responder_llms,
+        'evaluator_llms': chorus_model.evaluator_llms,
+        'n_results': n_results
+    }
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()
+
+class ResponseCache:
+    """
+    Opt-in cache of chorus results for repeated questions
+    Entries are keyed by (bot id, chorus config hash, dataset version, normalized query), so
+    any change to the bot, its chorus model or its dataset's files misses the cache. Entries
+    expire after ttl_seconds; entries for older dataset versions are purged on write.
+    """
+    def __init__(self, enabled: bool = None, ttl_seconds: float = None):
+        self.enabled = enabled if enabled is not None else os.getenv('RESPONSE_CACHE_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+        self.ttl_seconds = ttl_seconds or float(os.getenv('RESPONSE_CACHE_TTL', '86400'))
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def key(bot, chorus_model, dataset, query: str, n_results: int) -> str:
+        parts = [
+            str(bot.id),
+            config_hash(bot, chorus_model, n_results),
+            f"{dataset.id}:{dataset.version}" if dataset else '-',
+            normalize_query(query)
+        ]
+        return hashlib.sha256('\x1f'.join(parts).encode('utf-8')).hexdigest()
+    
+    def get(self, db, cache_key: str) -> Dict:
+        """Return the cached run_chorus result, or None"""
+        entry = db.query(CachedResponse).filter(
+            CachedResponse.cache_key == cache_key,
+            CachedResponse.expires_at > datetime.now(UTC)
+        ).first()
+        
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        
+        entry.hits = (entry.hits or 0) + 1
+        return entry.result
+    
+    def put(self, db, cache_key: str, bot, dataset, result: Dict):
+        """Store a run_chorus result (the caller commits)"""
+        now = datetime.now(UTC)
+        # Drop expired entries and answers computed against older versions of this dataset
+        db.query(CachedResponse).filter(CachedResponse.expires_at <= now).delete(synchronize_session=False)
+        if dataset:
+            db.query(CachedResponse).filter(
+                CachedResponse.dataset_id == dataset.id,
+                CachedResponse.dataset_version != dataset.version
+            ).delete(synchronize_session=False)
+        db.query(CachedResponse).filter_by(cache_key=cache_key).delete(synchronize_session=False)
+        
+        db.add(CachedResponse(
+            cache_key=cache_key,
+            bot_id=bot.id,
+            dataset_id=dataset.id if dataset else None,
+            dataset_version=dataset.version if dataset else None,
+            result=result,
+            hits=0,
+            created_at=now,
+            expires_at=now + timedelta(seconds=self.ttl_seconds)
+        ))
+    
+    @staticmethod
+    def cacheable(result: Dict) -> bool:
+        """Don't cache answers that are provider error strings"""
+        return not result['final_response'].startswith('Error:')
+    
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            'enabled': self.enabled,
+            'ttl_seconds': self.ttl_seconds,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
@@ -0,0 +1,42 @@
+import threading
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Rough characters-per-token ratio used when no tokenizer is available
+CHARS_PER_TOKEN = 4
+
+_encodings = {}
+_encodings_lock = threading.RLock()
+
+def get_encoding(model: str = None):
+    """
+    Return a cached tiktoken encoding for a model, or None if tiktoken (or its
+    vocabulary download) is unavailable
+    """
+    if tiktoken is None:
+        return None
+    key = model or 'cl100k_base'
+    if key not in _encodings:
+        with _encodings_lock:
+            if key not in _encodings:
+                try:
+                    _encodings[key] = tiktoken.encoding_for_model(model) if model else tiktoken.get_encoding('cl100k_base')
+                except KeyError:
+                    # Non-OpenAI model names: cl100k is a close enough approximation
+                    _encodings[key] = get_encoding(None)
+                except Exception as e:
+                    print(f"Tokenizer unavailable for {key}, estimating token counts: {e}")
+                    _encodings[key] = None
+    return _encodings[key]
+
+def count_tokens(text: str, model: str = None) -> int:
+    """Count tokens in text for a model (estimated from length without a tokenizer)"""
+    if not text:
+        return 0
+    encoding = get_encoding(model)
+    if encoding is None:
+        return max(1, len(text) // CHARS_PER_TOKEN)
+    return len(encoding.encode(text, disallowed_special=()))
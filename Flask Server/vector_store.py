@@ -1,21 +1,129 @@
 import chromadb
-from openai import OpenAI
+import openai
+from llm_service import get_llm_service
+from token_utils import count_tokens
+from embedding_cache import EmbeddingCache, QueryEmbeddingCache
+from lexical_index import LexicalIndex
+from reranker import Reranker
+import numpy as np
 import os
+import time
 from typing import List, Dict
 import uuid
 
+EMBEDDING_MODEL = "text-embedding-ada-002"
+RETRIEVAL_MODES = ['vector', 'hybrid', 'lexical']
+# Embedding errors worth retrying; anything else (bad input, auth) fails immediately
+RETRYABLE_EMBEDDING_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError, openai.InternalServerError)
+
+# Chroma server shared by every process that reads or writes vectors; without one each
+# process opens its own embedded store and never sees another process's writes
+CHROMA_HOST = os.getenv('CHROMA_HOST')
+CHROMA_PORT = int(os.getenv('CHROMA_PORT', '8000'))
+
+def create_chroma_client():
+    """HttpClient for CHROMA_HOST when set, otherwise the embedded store in ./chroma_data"""
+    if CHROMA_HOST:
+        return chromadb.HttpClient(host=CHROMA_HOST, port=CHROMA_PORT)
+    return chromadb.PersistentClient(path="./chroma_data")
+
 class VectorStore:
     def __init__(self):
-        self.client = chromadb.PersistentClient(path="./chroma_data")
-        self.openai_client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+        self.client = create_chroma_client()
+        # Reuse the shared OpenAI client and its connection pool
+        self.openai_client = get_llm_service().openai_client
+        # Limits for one embeddings request (the API caps a request at 2048 inputs)
+        self.embedding_batch_size = int(os.getenv('EMBEDDING_BATCH_SIZE', '512'))
+        self.embedding_batch_tokens = int(os.getenv('EMBEDDING_BATCH_TOKENS', '100000'))
+        self.embedding_max_retries = int(os.getenv('EMBEDDING_MAX_RETRIES', '5'))
+        # Persistent (model, text hash) -> embedding cache shared by ingestion and queries
+        self.embedding_cache = None
+        if os.getenv('EMBEDDING_CACHE_ENABLED', 'true').lower() in ('1', 'true', 'yes'):
+            self.embedding_cache = EmbeddingCache()
+        # Hot chat queries are answered from memory before touching the persistent cache
+        self.query_cache = QueryEmbeddingCache()
+        # BM25 keyword index kept alongside each collection for hybrid retrieval
+        self.lexical_index = LexicalIndex()
+        self.retrieval_mode = os.getenv('RETRIEVAL_MODE', 'hybrid')
+        # Each retriever fetches n_results * this many candidates before fusion
+        self.hybrid_candidate_multiplier = int(os.getenv('HYBRID_CANDIDATE_MULTIPLIER', '3'))
+        self.rrf_k = int(os.getenv('RRF_K', '60'))
+        self._lexical_synced = set()
+        # Rerank stage: over-fetch n_results * this many candidates, rerank, then trim
+        self.reranker = Reranker()
+        self.rerank_candidate_multiplier = int(os.getenv('RERANK_CANDIDATE_MULTIPLIER', '4'))
     
     def get_embedding(self, text: str) -> List[float]:
         """Generate embedding using OpenAI"""
-        response = self.openai_client.embeddings.create(
-            model="text-embedding-ada-002",
-            input=text
-        )
-        return response.data[0].embedding
+        return self.get_embeddings([text])[0]
+    
+    def get_embeddings(self, texts: List[str]) -> List[List[float]]:
+        """Generate embeddings for many texts in input order, skipping cached ones"""
+        if not self.embedding_cache:
+            return self._embed_batch(texts)
+        
+        cached = self.embedding_cache.get_many(EMBEDDING_MODEL, texts)
+        missing = list(dict.fromkeys(
+            text for text in texts if EmbeddingCache.text_hash(text) not in cached
+        ))
+        if missing:
+            embeddings = self._embed_batch(missing)
+            self.embedding_cache.put_many(EMBEDDING_MODEL, missing, embeddings)
+            for text, embedding in zip(missing, embeddings):
+                cached[EmbeddingCache.text_hash(text)] = embedding
+        
+        return [cached[EmbeddingCache.text_hash(text)] for text in texts]
+    
+    def get_query_embedding(self, query_text: str) -> List[float]:
+        """Embed a chat query, using the in-process LRU cache"""
+        query_text = query_text.strip()
+        embedding = self.query_cache.get(EMBEDDING_MODEL, query_text)
+        if embedding is None:
+            embedding = self.get_embedding(query_text)
+            self.query_cache.put(EMBEDDING_MODEL, query_text, embedding)
+        return embedding
+    
+    def cache_stats(self) -> Dict:
+        """Counters for the query and persistent embedding caches"""
+        return {
+            'query_embeddings': self.query_cache.stats(),
+            'embeddings': self.embedding_cache.stats() if self.embedding_cache else None
+        }
+    
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        """Embed texts with one API request, in input order; rate limits and transient errors are retried with backoff"""
+        for attempt in range(self.embedding_max_retries + 1):
+            try:
+                response = self.openai_client.embeddings.create(
+                    model=EMBEDDING_MODEL,
+                    input=texts
+                )
+                return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+            except RETRYABLE_EMBEDDING_ERRORS as e:
+                if attempt == self.embedding_max_retries:
+                    raise
+                delay = min(2 ** attempt, 30)
+                print(f"Embedding batch of {len(texts)} failed ({e}), retrying in {delay}s...")
+                time.sleep(delay)
+    
+    def _batch_documents(self, documents: List[Dict]) -> List[List[Dict]]:
+        """Split documents into batches bounded by input count and total tokens"""
+        batches = []
+        batch = []
+        batch_tokens = 0
+        
+        for doc in documents:
+            tokens = count_tokens(doc['text'], EMBEDDING_MODEL)
+            if batch and (len(batch) >= self.embedding_batch_size or batch_tokens + tokens > self.embedding_batch_tokens):
+                batches.append(batch)
+                batch = []
+                batch_tokens = 0
+            batch.append(doc)
+            batch_tokens += tokens
+        
+        if batch:
+            batches.append(batch)
+        return batches
     
     def create_collection(self, collection_name: str):
         """Create a new collection for a dataset"""
@@ -26,58 +134,248 @@ class VectorStore:
             print(f"Error creating collection: {e}")
             return None
     
-    def add_documents(self, collection_name: str, documents: List[Dict]):
+    @staticmethod
+    def chunk_id(file_key: str, chunk_index: int) -> str:
+        """Deterministic vector id for a file's chunk"""
+        return f"{file_key}:{chunk_index}"
+    
+    def _keyed_documents(self, file_key: str, documents: List[Dict]) -> List[Dict]:
+        """Attach deterministic ids plus file_key/content_hash metadata to a file's chunks"""
+        keyed = []
+        for i, doc in enumerate(documents):
+            metadata = dict(doc.get('metadata', {}))
+            metadata['file_key'] = file_key
+            metadata['content_hash'] = EmbeddingCache.text_hash(doc['text'])
+            keyed.append({
+                'id': self.chunk_id(file_key, metadata.get('chunk_index', i)),
+                'text': doc['text'],
+                'metadata': metadata
+            })
+        return keyed
+    
+    def _write_documents(self, collection, documents: List[Dict]):
+        # Embed and write in bulk, one embeddings request and one Chroma write per batch
+        for batch in self._batch_documents(documents):
+            texts = [doc['text'] for doc in batch]
+            embeddings = self.get_embeddings(texts)
+            metadatas = [doc.get('metadata', {}) for doc in batch]
+            ids = [doc['id'] for doc in batch]
+            
+            collection.upsert(
+                embeddings=embeddings,
+                documents=texts,
+                metadatas=metadatas,
+                ids=ids
+            )
+            self.lexical_index.upsert(collection.name, ids, texts, metadatas)
+    
+    def add_documents(self, collection_name: str, documents: List[Dict], file_key: str = None):
         """
         Add documents to a collection
         documents format: [{"text": "content", "metadata": {...}}]
+        With a file_key, chunk ids are derived from it and the chunk index, so re-adding a
+        file overwrites its vectors instead of duplicating them.
         """
         collection = self.client.get_or_create_collection(name=collection_name)
         
-        for doc in documents:
-            text = doc['text']
-            metadata = doc.get('metadata', {})
-            
-            # Generate embedding
-            embedding = self.get_embedding(text)
-            
-            # Add to collection
-            collection.add(
-                embeddings=[embedding],
-                documents=[text],
-                metadatas=[metadata],
-                ids=[str(uuid.uuid4())]
+        if file_key:
+            documents = self._keyed_documents(file_key, documents)
+        else:
+            documents = [dict(doc, id=str(uuid.uuid4())) for doc in documents]
+        self._write_documents(collection, documents)
+    
+    def sync_file_documents(self, collection_name: str, file_key: str, documents: List[Dict]) -> Dict:
+        """
+        Replace a file's chunks, re-embedding only the ones whose content changed
+        Returns counts of added/updated/unchanged/removed chunks.
+        """
+        collection = self.client.get_or_create_collection(name=collection_name)
+        existing = collection.get(where={'file_key': file_key}, include=['metadatas'])
+        existing_hashes = {
+            vector_id: (metadata or {}).get('content_hash')
+            for vector_id, metadata in zip(existing['ids'], existing['metadatas'])
+        }
+        
+        changed = []
+        unchanged = []
+        for doc in self._keyed_documents(file_key, documents):
+            if existing_hashes.get(doc['id']) == doc['metadata']['content_hash']:
+                unchanged.append(doc)
+            else:
+                changed.append(doc)
+        
+        self._write_documents(collection, changed)
+        if unchanged:
+            # Same text, so keep the embedding but refresh metadata (page, offsets, totals)
+            collection.update(
+                ids=[doc['id'] for doc in unchanged],
+                metadatas=[doc['metadata'] for doc in unchanged]
             )
+            self.lexical_index.update_metadata(collection_name, [doc['id'] for doc in unchanged], [doc['metadata'] for doc in unchanged])
+        
+        new_ids = {doc['id'] for doc in changed + unchanged}
+        stale_ids = [vector_id for vector_id in existing_hashes if vector_id not in new_ids]
+        if stale_ids:
+            collection.delete(ids=stale_ids)
+            self.lexical_index.delete(collection_name, ids=stale_ids)
+        
+        return {
+            'added': sum(1 for doc in changed if doc['id'] not in existing_hashes),
+            'updated': sum(1 for doc in changed if doc['id'] in existing_hashes),
+            'unchanged': len(unchanged),
+            'removed': len(stale_ids)
+        }
+    
+    def has_file_documents(self, collection_name: str, file_key: str) -> bool:
+        """Whether any vectors are stored under a file_key"""
+        collection = self.client.get_or_create_collection(name=collection_name)
+        return bool(collection.get(where={'file_key': file_key}, limit=1)['ids'])
     
-    def query_collection(self, collection_name: str, query_text: str, n_results: int = 5) -> List[Dict]:
-        """Query a collection and return relevant documents"""
+    def delete_file_documents(self, collection_name: str, file_key: str = None, filename: str = None):
+        """
+        Delete one file's vectors by file_key
+        filename matches vectors written before chunk ids were keyed by file; only pass it
+        when no other file in the collection shares the name.
+        """
         try:
             collection = self.client.get_collection(name=collection_name)
-            query_embedding = self.get_embedding(query_text)
-            
-            results = collection.query(
-                query_embeddings=[query_embedding],
-                n_results=n_results
-            )
+        except Exception:
+            return
+        
+        if file_key:
+            collection.delete(where={'file_key': file_key})
+        if filename:
+            collection.delete(where={'filename': filename})
+        self.lexical_index.delete(collection_name, file_key=file_key, filename=filename)
+    
+    def query_collection(self, collection_name: str, query_text: str, n_results: int = 5, mode: str = None, rerank: bool = True, max_tokens: int = None) -> List[Dict]:
+        """
+        Query a collection and return relevant documents
+        mode: 'vector' (dense only), 'lexical' (BM25 only) or 'hybrid' (both, fused with
+        reciprocal-rank fusion); defaults to RETRIEVAL_MODE.
+        With rerank, candidates are over-fetched and passed through the rerank stage; pass
+        max_tokens to also cap the chunks' total tokens (otherwise RERANK_MAX_TOKENS, off by
+        default, since prompt context is packed by ContextBuilder).
+        Returns: [{"id", "text", "metadata", "distance", "score"}], best first
+        """
+        mode = mode or self.retrieval_mode
+        rerank = rerank and self.reranker.enabled
+        try:
+            collection = self.client.get_collection(name=collection_name)
+            candidates = n_results * self.rerank_candidate_multiplier if rerank else n_results
+            results = self._retrieve(collection, query_text, candidates, mode)
             
-            # Format results
-            formatted_results = []
-            if results['documents']:
-                for i, doc in enumerate(results['documents'][0]):
-                    formatted_results.append({
-                        'text': doc,
-                        'metadata': results['metadatas'][0][i] if results['metadatas'] else {},
-                        'distance': results['distances'][0][i] if results['distances'] else 0
-                    })
+            if rerank:
+                if self.reranker.needs_embeddings:
+                    embeddings = self._stored_embeddings(collection, [result['id'] for result in results])
+                    for result in results:
+                        result['embedding'] = embeddings.get(result['id'])
+                results = self.reranker.rerank(query_text, self.get_query_embedding(query_text), results, n_results, max_tokens)
             
-            return formatted_results
+            self._fill_distances(collection, query_text, results)
+            return results
         except Exception as e:
             print(f"Error querying collection: {e}")
             return []
     
+    def _retrieve(self, collection, query_text: str, n_results: int, mode: str) -> List[Dict]:
+        """First-stage retrieval for one mode, best first"""
+        if mode == 'vector':
+            return self._vector_search(collection, query_text, n_results)
+        
+        self._sync_lexical_index(collection)
+        candidates = n_results * self.hybrid_candidate_multiplier
+        lexical_results = self.lexical_index.search(collection.name, query_text, candidates if mode == 'hybrid' else n_results)
+        vector_results = self._vector_search(collection, query_text, candidates) if mode == 'hybrid' else []
+        
+        # Reciprocal-rank fusion: score = sum of 1 / (k + rank) over the rankings a chunk appears in
+        fused = {}
+        for ranking in (vector_results, lexical_results):
+            for rank, result in enumerate(ranking):
+                entry = fused.setdefault(result['id'], {
+                    'id': result['id'],
+                    'text': result['text'],
+                    'metadata': result['metadata'],
+                    'distance': result.get('distance'),
+                    'score': 0.0
+                })
+                entry['score'] += 1.0 / (self.rrf_k + rank + 1)
+        
+        return sorted(fused.values(), key=lambda result: result['score'], reverse=True)[:n_results]
+    
+    def _stored_embeddings(self, collection, ids: List[str]) -> Dict[str, List[float]]:
+        """Embeddings already stored in Chroma for some vector ids"""
+        if not ids:
+            return {}
+        stored = collection.get(ids=ids, include=['embeddings'])
+        return dict(zip(stored['ids'], stored['embeddings']))
+    
+    def _vector_search(self, collection, query_text: str, n_results: int) -> List[Dict]:
+        """Dense nearest-neighbour search"""
+        query_embedding = self.get_query_embedding(query_text)
+        
+        results = collection.query(
+            query_embeddings=[query_embedding],
+            n_results=n_results
+        )
+        
+        # Format results
+        formatted_results = []
+        if results['documents']:
+            for i, doc in enumerate(results['documents'][0]):
+                distance = results['distances'][0][i] if results['distances'] else 0
+                formatted_results.append({
+                    'id': results['ids'][0][i],
+                    'text': doc,
+                    'metadata': results['metadatas'][0][i] if results['metadatas'] else {},
+                    'distance': distance,
+                    'score': -distance
+                })
+        
+        return formatted_results
+    
+    def _fill_distances(self, collection, query_text: str, results: List[Dict]):
+        """Compute vector distances for keyword-only hits so every result carries one"""
+        missing = [result for result in results if result['distance'] is None]
+        if not missing:
+            return
+        
+        embeddings = self._stored_embeddings(collection, [result['id'] for result in missing])
+        query_embedding = np.asarray(self.get_query_embedding(query_text), dtype=np.float32)
+        space = (collection.metadata or {}).get('hnsw:space', 'l2')
+        
+        for result in missing:
+            embedding = embeddings.get(result['id'])
+            if embedding is None:
+                result['distance'] = float('inf')
+                continue
+            embedding = np.asarray(embedding, dtype=np.float32)
+            if space == 'cosine':
+                result['distance'] = float(1 - embedding.dot(query_embedding) / (np.linalg.norm(embedding) * np.linalg.norm(query_embedding)))
+            elif space == 'ip':
+                result['distance'] = float(1 - embedding.dot(query_embedding))
+            else:
+                result['distance'] = float(np.sum((embedding - query_embedding) ** 2))
+    
+    def _sync_lexical_index(self, collection):
+        """Backfill the keyword index for collections indexed before it existed"""
+        if collection.name in self._lexical_synced:
+            return
+        
+        total = collection.count()
+        if self.lexical_index.count(collection.name) != total:
+            print(f"Rebuilding keyword index for {collection.name} ({total} chunks)")
+            self.lexical_index.delete_collection(collection.name)
+            for offset in range(0, total, 1000):
+                page = collection.get(offset=offset, limit=1000, include=['documents', 'metadatas'])
+                self.lexical_index.upsert(collection.name, page['ids'], page['documents'], [metadata or {} for metadata in page['metadatas']])
+        self._lexical_synced.add(collection.name)
+    
     def delete_collection(self, collection_name: str):
         """Delete a collection"""
         try:
             self.client.delete_collection(name=collection_name)
+            self.lexical_index.delete_collection(collection_name)
         except Exception as e:
             print(f"Error deleting collection: {e}")
 
@@ -11,17 +11,22 @@ const api = axios.create({
 
 // Datasets
 export const getDatasets = () => api.get('/datasets')
-export const getDataset = (datasetId) => api.get(`/datasets/${datasetId}`)
+// Returns the latest page of files; pass { all: true } for every file, older pages via getDatasetFiles
+export const getDataset = (datasetId, params = {}) => api.get(`/datasets/${datasetId}`, { params })
 export const createDataset = (data) => api.post('/datasets', data)
 export const uploadFiles = async (datasetId, files, onProgress) => {
   const formData = new FormData()
   files.forEach(file => formData.append('files', file))
   
-  // Use fetch with streaming for real-time progress updates
-  const response = await fetch(`${API_BASE_URL}/datasets/${datasetId}/upload`, {
+  // The upload queues an ingestion job; progress is streamed from the job
+  const uploadResponse = await fetch(`${API_BASE_URL}/datasets/${datasetId}/upload`, {
     method: 'POST',
     body: formData
   })
+  const job = await uploadResponse.json()
+  if (!uploadResponse.ok) throw new Error(job.error)
+  
+  const response = await fetch(`${API_BASE_URL}/jobs/${job.job_id}/stream`)
   
   const reader = response.body.getReader()
   const decoder = new TextDecoder()
@@ -41,7 +46,7 @@ export const uploadFiles = async (datasetId, files, onProgress) => {
     for (const line of lines) {
       if (!line.trim()) continue
       
-      // Parse SSE format: "event: type\ndata: {...}"
+      // Parse SSE format: "[id: n\n]event: type\ndata: {...}"
       const eventMatch = line.match(/event: (\w+)\ndata: (.+)/)
       if (eventMatch) {
         const [_, eventType, dataStr] = eventMatch
@@ -60,9 +65,16 @@ export const uploadFiles = async (datasetId, files, onProgress) => {
   
   return { data: finalResult }
 }
+export const getJob = (jobId) => api.get(`/jobs/${jobId}`)
 export const deleteDataset = (datasetId) => api.delete(`/datasets/${datasetId}`)
 export const getFileContent = (datasetId, fileId) => api.get(`/datasets/${datasetId}/files/${fileId}`)
 export const getFileImage = (datasetId, fileId) => `${API_BASE_URL}/datasets/${datasetId}/files/${fileId}/image`
+export const getDatasetFiles = (datasetId, params = {}) => api.get(`/datasets/${datasetId}/files`, { params })
+export const updateFile = (datasetId, fileId, file) => {
+  const formData = new FormData()
+  formData.append('file', file)
+  return fetch(`${API_BASE_URL}/datasets/${datasetId}/files/${fileId}`, { method: 'PUT', body: formData }).then(r => r.json())
+}
 export const deleteFile = (datasetId, fileId) => api.delete(`/datasets/${datasetId}/files/${fileId}`)
 
 // Chorus Models
@@ -86,7 +98,8 @@ export const chatWithBot = (botId, message, ragCount = null, imageSettings = nul
   }
   return api.post(`/bots/${botId}/chat`, payload)
 }
-export const getChatHistory = (botId) => api.get(`/bots/${botId}/history`)
+// params: { before, limit } or { all: true } - the cursor for older messages is in the X-Next-Before response header
+export const getChatHistory = (botId, params = {}) => api.get(`/bots/${botId}/history`, { params })
 
 // Health Check
 export const checkHealth = () => api.get('/health')
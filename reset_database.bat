@@ -21,12 +21,23 @@ if exist chorus.db\NUL (
 ) else (
     if exist chorus.db del /q /f chorus.db
 )
+rem WAL journal files
+if exist chorus.db-wal del /q /f chorus.db-wal
+if exist chorus.db-shm del /q /f chorus.db-shm
 echo.
 
 echo Deleting old vector store...
 if exist chroma_data rmdir /s /q chroma_data
 echo.
 
+echo Deleting embedding cache...
+if exist embedding_cache.db del /q /f embedding_cache.db*
+echo.
+
+echo Deleting keyword index...
+if exist lexical_index.db del /q /f lexical_index.db*
+echo.
+
 echo Deleting uploaded files...
 if exist uploads rmdir /s /q uploads
 echo.